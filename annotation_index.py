@@ -0,0 +1,129 @@
+"""
+Scanning of the dataset for images and annotation files, and the in-memory index built from it of which images
+have an annotation file, used to jump straight to the next annotated/un-annotated image and to count annotated
+images without touching the disk
+"""
+
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from path_table import path_stem
+
+# Matched case-insensitively, so e.g. .JPG files are found too
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MANIFEST_VERSION = 1
+# Directories listed at once while scanning; listing a network share is dominated by latency, not bandwidth
+SCAN_WORKERS = 16
+
+
+# Lists one directory of the library as (mtime, subdirectory names, image names, annotation file names). The mtime
+# is taken before listing, so that changes made while listing show up as a changed directory on the next scan.
+def list_directory(lib_path, rel_dir, file_extension):
+    path = os.path.join(lib_path, rel_dir)
+    mtime = os.stat(path).st_mtime_ns
+    subdirs = []
+    images = []
+    annotations = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(entry.name)
+            elif entry.name.endswith(file_extension):
+                annotations.append(entry.name)
+    return mtime, subdirs, images, annotations
+
+
+# Directory listings saved by an earlier scan of lib_path for file_extension, keyed by relative directory
+def load_manifest(manifest_file, lib_path, file_extension):
+    if manifest_file is None or not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, 'rb') as f:
+            saved = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    if not isinstance(saved, dict) or saved.get('version') != MANIFEST_VERSION or \
+            saved.get('lib_path') != os.path.abspath(lib_path) or saved.get('file_extension') != file_extension:
+        return {}
+    return saved['dirs']
+
+
+# Lists the dataset, returning the relative paths of all images, the set of relative paths of the annotation files
+# (ending in file_extension) found next to them, and the mtime of every directory, by relative path. Directories
+# are listed in parallel. With a manifest_file, every directory's listing is saved along with its mtime, and later
+# scans only list the directories whose mtime has changed (which happens whenever files are added to, removed from or
+# renamed in them), just stat-ing the others.
+def scan_library(lib_path, file_extension, manifest_file=None, workers=SCAN_WORKERS):
+    saved = load_manifest(manifest_file, lib_path, file_extension)
+    listings = {}
+    listed = 0
+
+    def visit(rel_dir):
+        listing = saved.get(rel_dir)
+        if listing is not None and os.stat(os.path.join(lib_path, rel_dir)).st_mtime_ns == listing[0]:
+            return rel_dir, listing, False
+        return rel_dir, list_directory(lib_path, rel_dir, file_extension), True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(visit, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    rel_dir, listing, was_listed = future.result()
+                except FileNotFoundError:  # A subdirectory removed while scanning
+                    continue
+                listings[rel_dir] = listing
+                listed += was_listed
+                for name in listing[1]:
+                    pending.add(pool.submit(visit, os.path.join(rel_dir, name)))
+
+    images = []
+    annotations = set()
+    for rel_dir in sorted(listings):
+        _, _, image_names, annotation_names = listings[rel_dir]
+        images.extend(os.path.join(rel_dir, name) for name in image_names)
+        annotations.update(os.path.join(rel_dir, name) for name in annotation_names)
+    if manifest_file is not None and (listed or len(listings) != len(saved)):
+        with open(manifest_file, 'wb') as f:
+            pickle.dump({'version': MANIFEST_VERSION, 'lib_path': os.path.abspath(lib_path),
+                         'file_extension': file_extension, 'dirs': listings}, f)
+    return images, annotations, {rel_dir: listing[0] for rel_dir, listing in listings.items()}
+
+
+# Bitset over the sorted image list (self.paths in the annotators) marking which images have an annotation file,
+# along with the number of annotated images. Built once at startup and kept up to date through mark() whenever the
+# app writes or removes an annotation file.
+class AnnotationIndex:
+    def __init__(self, annotated):
+        self.annotated = np.asarray(annotated, dtype=bool)
+        self.count = int(np.count_nonzero(self.annotated))
+
+    # Builds the index from the annotation files found by scan_library, without any further disk access
+    @classmethod
+    def build(cls, paths, annotation_files, file_extension):
+        return cls([path_stem(p) + file_extension in annotation_files for p in paths])
+
+    def __len__(self):
+        return len(self.annotated)
+
+    def mark(self, ind, annotated):
+        if self.annotated[ind] != annotated:
+            self.annotated[ind] = annotated
+            self.count += 1 if annotated else -1
+
+    # Index of the first image after ind whose status matches annotated. As with stepping through images one by one,
+    # the search stops at the first image (index 0) once it passes the end of the dataset.
+    def find_next(self, ind, annotated=True):
+        matches = np.flatnonzero(self.annotated[ind + 1:] == annotated)
+        return int(matches[0]) + ind + 1 if len(matches) > 0 else 0
+
+    # Index of the first image before ind whose status matches annotated, wrapping around from the first image to
+    # the last and stopping at the first image (index 0) if nothing matches
+    def find_prev(self, ind, annotated=True):
+        end = ind if ind > 0 else len(self.annotated)
+        matches = np.flatnonzero(self.annotated[1:end] == annotated)
+        return int(matches[-1]) + 1 if len(matches) > 0 else 0
@@ -0,0 +1,172 @@
+"""
+Array-backed model of the bounding box annotations of one image, as edited by the annotators
+"""
+
+import itertools
+import numpy as np
+
+# Source of AnnotationStore.version stamps; every change to any store takes a new one
+VERSIONS = itertools.count()
+
+
+# Interned label names, so that boxes can refer to their label by an integer id. Names are only ever added, which
+# lets every store of an app share one table.
+class LabelTable:
+    def __init__(self, names=()):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.id(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, name):
+        ind = self.ids.get(name)
+        if ind is None:
+            ind = len(self.names)
+            self.names.append(name)
+            self.ids[name] = ind
+        return ind
+
+
+# Boxes of an image as an N x 4 float array of their two corners (x0, y0, x1, y1), in the order they were placed
+# (so not necessarily min before max until normalize() is called), with the label id of each box in class_ids and
+# the first corner of a box still being drawn, if any, in pending. Corners are also addressed as points: point 2 * i
+# is the first corner of box i and point 2 * i + 1 its second, with the pending corner last.
+#
+# snapshot() returns a copy which shares the arrays with the original until either of them is changed, so taking one
+# per save or for undo costs next to nothing. Every change takes a new version stamp, which caches built from the
+# annotations (see box_index.BoxIndex) compare against.
+class AnnotationStore:
+    def __init__(self, label_table=None, boxes=None, class_ids=None, pending=None):
+        self.label_table = label_table if label_table is not None else LabelTable()
+        self.boxes = np.zeros((0, 4)) if boxes is None else np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.class_ids = np.zeros(0, dtype=np.int32) if class_ids is None else np.asarray(class_ids, dtype=np.int32)
+        self.pending = pending
+        self.shared = False
+        self.version = next(VERSIONS)
+
+    # Store for boxes given as (xmin, ymin, xmax, ymax) with a label name each, e.g. as read from a VOC file
+    @classmethod
+    def from_boxes(cls, boxes, labels, label_table=None):
+        store = cls(label_table, boxes)
+        store.class_ids = np.asarray([store.label_table.id(label) for label in labels], dtype=np.int32)
+        return store
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def snapshot(self):
+        copy = AnnotationStore(self.label_table, self.boxes, self.class_ids, self.pending)
+        copy.version = self.version
+        self.shared = copy.shared = True
+        return copy
+
+    # Called before every change: takes private copies of arrays shared with snapshots and a new version stamp
+    def modify(self):
+        if self.shared:
+            self.boxes = self.boxes.copy()
+            self.class_ids = self.class_ids.copy()
+            self.shared = False
+        self.version = next(VERSIONS)
+
+    # Number of corners placed, counting the pending one
+    def point_count(self):
+        return 2 * len(self.boxes) + (self.pending is not None)
+
+    # All corners as an M x 2 array, in point order
+    def points(self):
+        points = self.boxes.reshape(-1, 2)
+        if self.pending is not None:
+            points = np.concatenate([points, [self.pending]])
+        return points
+
+    def point(self, ind):
+        if ind == 2 * len(self.boxes) and self.pending is not None:
+            return self.pending
+        return tuple(self.boxes[ind // 2, ind % 2 * 2:ind % 2 * 2 + 2].tolist())
+
+    def set_point(self, ind, xy):
+        if ind == 2 * len(self.boxes) and self.pending is not None:
+            self.modify()
+            self.pending = tuple(xy)
+        else:
+            self.boxes[ind // 2]  # Raises IndexError for points which don't exist, before anything is changed
+            self.modify()
+            self.boxes[ind // 2, ind % 2 * 2:ind % 2 * 2 + 2] = xy
+
+    def set_box(self, ind, box):
+        self.modify()
+        self.boxes[ind] = box
+
+    def label(self, ind):
+        return self.label_table.names[self.class_ids[ind]]
+
+    def labels(self):
+        return [self.label_table.names[i] for i in self.class_ids.tolist()]
+
+    def set_label(self, ind, name):
+        self.modify()
+        self.class_ids[ind] = self.label_table.id(name)
+
+    # Places a corner: the first one starts a new box, left pending until the second one completes it with the given
+    # label. Returns whether a box was completed.
+    def add_point(self, xy, label):
+        self.modify()
+        if self.pending is None:
+            self.pending = tuple(xy)
+            return False
+        self.boxes = np.concatenate([self.boxes, [tuple(self.pending) + tuple(xy)]])
+        self.class_ids = np.append(self.class_ids, np.int32(self.label_table.id(label)))
+        self.pending = None
+        return True
+
+    def remove_box(self, ind):
+        self.modify()
+        self.boxes = np.delete(self.boxes, ind, axis=0)
+        self.class_ids = np.delete(self.class_ids, ind)
+
+    def clear_pending(self):
+        self.modify()
+        self.pending = None
+
+    def clear(self):
+        self.modify()
+        self.boxes = np.zeros((0, 4))
+        self.class_ids = np.zeros(0, dtype=np.int32)
+        self.pending = None
+
+    # Swaps a box's corners for its other two corners, keeping the box itself as it is
+    def flip_corners(self, ind):
+        self.modify()
+        self.boxes[ind] = self.boxes[ind, [0, 3, 2, 1]]
+
+    # Boxes rounded to whole pixels, with (xmin, ymin, xmax, ymax) corners, as an N x 4 integer array
+    def voc_boxes(self):
+        rounded = np.round(self.boxes)
+        return np.concatenate([np.minimum(rounded[:, :2], rounded[:, 2:]),
+                               np.maximum(rounded[:, :2], rounded[:, 2:])], axis=1).astype(np.int64)
+
+    # Rounds every corner to whole pixels and reorders each box's corners to (xmin, ymin), (xmax, ymax), as they
+    # are saved in Pascal VOC format
+    def normalize(self):
+        self.modify()
+        self.boxes = self.voc_boxes().astype(np.float64)
+        if self.pending is not None:
+            self.pending = tuple(int(round(c)) for c in self.pending)
+
+    # Limits every corner to the image area
+    def clip(self, width, height):
+        self.modify()
+        self.boxes = np.clip(self.boxes, 0, [width, height, width, height])
+        if self.pending is not None:
+            self.pending = (min(max(0, self.pending[0]), width), min(max(0, self.pending[1]), height))
+
+    # Rotates every corner a quarter turn, (x, y) -> (extent - y, x)
+    def rotate(self, extent):
+        self.modify()
+        self.boxes = np.stack([extent - self.boxes[:, 1], self.boxes[:, 0],
+                               extent - self.boxes[:, 3], self.boxes[:, 2]], axis=1)
+        if self.pending is not None:
+            self.pending = (extent - self.pending[1], self.pending[0])
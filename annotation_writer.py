@@ -0,0 +1,116 @@
+"""
+Write-behind saving of annotation files, so that saving never stalls the UI thread
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# How long a queued write waits for newer saves of the same file to replace it, in seconds
+COALESCE_DELAY = 0.25
+
+
+def contents_hash(contents):
+    return hashlib.sha1(contents.encode('utf-8')).digest()
+
+
+# Writes files on a background thread. A queued write waits COALESCE_DELAY seconds from when it was queued, and
+# queuing another write for the same file in the meantime replaces its contents, so that a burst of saves (e.g. while
+# moving or relabelling boxes) results in a single write. Writes are skipped when the file already has the exact
+# contents (going by a hash of what was last written to each file), and go through a temporary file which is renamed
+# over the target, so a file is never left half-written.
+class AnnotationWriter:
+    def __init__(self, delay=COALESCE_DELAY):
+        self.delay = delay
+        self.pending = OrderedDict()
+        self.in_flight = None
+        self.written = {}
+        self.flushing = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='AnnotationWriter', daemon=True)
+        self.thread.start()
+
+    # Queues contents to be written to path. contents can be a string, or a function returning the string, which
+    # is then called on the writer thread (only for the write which actually goes ahead).
+    def write(self, path, contents):
+        with self.cond:
+            queued = self.pending.get(path)
+            if queued is not None:
+                # Keeps the write's place in the queue and its deadline
+                self.pending[path] = (contents, queued[1])
+                return
+            was_idle = not self.pending
+            self.pending[path] = (contents, time.monotonic() + self.delay)
+            # Otherwise the writer is already waiting on an earlier deadline
+            if was_idle:
+                self.cond.notify_all()
+
+    # Drops any queued write to path and waits for a write to it which is already under way, e.g. before the file
+    # is deleted
+    def cancel(self, path):
+        with self.cond:
+            self.pending.pop(path, None)
+            while self.in_flight == path:
+                self.cond.wait()
+            self.written.pop(path, None)
+
+    # Blocks until every queued write has been written
+    def flush(self):
+        with self.cond:
+            self.flushing += 1
+            self.cond.notify_all()
+            while self.pending or self.in_flight is not None:
+                self.cond.wait()
+            self.flushing -= 1
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed and not self.pending:
+                    return
+                # Gives further saves of the first queued file until its deadline to replace it, unless everything
+                # is to be written out now
+                while self.pending and not self.flushing and not self.closed:
+                    remaining = next(iter(self.pending.values()))[1] - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self.pending:
+                    continue
+                path, (contents, _) = self.pending.popitem(last=False)
+                self.in_flight = path
+            try:
+                self.write_now(path, contents)
+            except Exception as e:  # Anything going wrong in contents() too; the writer has to keep going
+                print('ERROR: Failed to save {}: {!r}'.format(path, e))
+            finally:
+                with self.cond:
+                    self.in_flight = None
+                    self.cond.notify_all()
+
+    def write_now(self, path, contents):
+        if callable(contents):
+            contents = contents()
+        if path not in self.written and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.written[path] = contents_hash(f.read())
+        digest = contents_hash(contents)
+        if self.written.get(path) == digest:
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+        self.written[path] = digest
@@ -0,0 +1,185 @@
+"""
+Headless pre-annotation of a whole library from object detection predictions. Every image without an OD annotation
+file gets the one snappy_OD_suggestions.py would save for it once touched (same predictions, same thresholds, same
+labels), so that annotators only need to review them. Settings are read from 'configurations/configs.txt' and
+'configurations/classes.txt', as in snappy_OD_suggestions.py.
+
+    python batch_preannotate.py [--dry-run] [--workers N]
+"""
+
+import os
+import time
+import argparse
+from functools import partial
+from collections import Counter
+
+import numpy as np
+from annotation_store import AnnotationStore
+from annotation_index import scan_library
+from image_cache import probe_image_dims
+from od_predictions import PredictionIndex, open_prediction_store, select_suggestions, xywh_to_corners
+from path_table import path_stem
+from voc_save_load import load_voc_boxes, save_to_voc_xml
+
+# As in snappy_OD_suggestions.py
+PREV_ANNOT_EXT = '_annotations.xml'
+FILE_EXT = '_od_annotations.xml'
+# Shared with snappy_OD_suggestions.py, which lists the library for the same file extension
+MANIFEST_FILE = 'library_manifest_od.pkl'
+# Below this many images to pre-annotate, starting worker processes costs more than it saves
+PROCESS_POOL_MIN_FILES = 500
+
+
+# Reads the settings pre-annotation uses from the config file, with the same defaults as snappy_OD_suggestions.py
+def load_configs():
+    lib_path = ''
+    db = 'Unknown'
+    prediction_pth = ''
+    prediction_thrsh = 0.5
+    iou_thrsh = 0.75
+    obs_rank = '-1'
+    if os.path.exists(os.path.join('configurations', 'configs.txt')):
+        with open(os.path.join('configurations', 'configs.txt'), 'r') as c:
+            for line in c.readlines():
+                line = line.strip()
+                if line.startswith('LIBRARY_PATH:'):
+                    lib_path = line[13:].strip()
+                if line.startswith('DATABASE:'):
+                    db = line[9:]
+                if line.startswith('PREDICTIONS_PATH:'):
+                    prediction_pth = line[17:]
+                if line.startswith('PREDICTION_THRESH:'):
+                    prediction_thrsh = float(line[18:])
+                if line.startswith('OD_OBSERVATION_RANK:'):
+                    obs_rank = int(line[20:])
+                if line.startswith('IOU_THRESH:'):
+                    iou_thrsh = float(line[11:])
+    return lib_path, db, prediction_pth, prediction_thrsh, obs_rank, iou_thrsh
+
+
+def load_classes():
+    class_keys = []
+    if os.path.exists(os.path.join('configurations', 'classes.txt')):
+        with open(os.path.join('configurations', 'classes.txt'), 'r') as c:
+            for line in c.readlines():
+                class_keys.append(line.strip())
+    return class_keys
+
+
+# Everything a worker needs to pre-annotate an image; small, so it is cheap to send to worker processes. The
+# prediction store is memory-mapped by each process itself, see load_predictions.
+class BatchJob:
+    def __init__(self, lib_path, database, store_dir, classes, score_thresh, iou_thresh, observation_rank, dry_run):
+        self.lib_path = lib_path
+        self.database = database
+        self.store_dir = store_dir
+        self.classes = classes
+        self.score_thresh = score_thresh
+        self.iou_thresh = iou_thresh
+        self.observation_rank = observation_rank
+        self.dry_run = dry_run
+        # Written into the files as their path, as the annotator does
+        self.cwd = os.getcwd()
+
+
+# Prediction stores opened by this process, by directory; predictions only held in memory are under None
+open_stores = {}
+
+
+def load_predictions(store_dir):
+    predictions = open_stores.get(store_dir)
+    if predictions is None:
+        predictions = open_stores[store_dir] = PredictionIndex.load(store_dir)
+    return predictions
+
+
+# Pre-annotates one image the way snappy_OD_suggestions.App.load_json_annotations and save_progress would: the
+# predictions scoring above the threshold which don't overlap any of its existing (PREV_ANNOT_EXT) boxes too much,
+# labelled by category id with the classes in classes.txt. Returns the labels of the boxes written (nothing is written
+# if there are none, as the annotator removes annotation files without boxes) and the number of predictions left out
+# for having a category with no class.
+def preannotate_image(job, rel_path):
+    bboxes, scores, category_ids = load_predictions(job.store_dir).get(path_stem(rel_path))
+    _, previous_boxes, _ = load_voc_boxes(job.lib_path, rel_path, PREV_ANNOT_EXT)
+    keep = select_suggestions(bboxes, scores, previous_boxes, job.score_thresh, job.iou_thresh)
+    known = (category_ids >= 1) & (category_ids <= len(job.classes))
+    unknown = int(np.count_nonzero(keep & ~known))
+    keep &= known
+    if not keep.any():
+        return [], unknown
+    labels = [job.classes[category_id - 1] for category_id in category_ids[keep].tolist()]
+    annotations = AnnotationStore.from_boxes(xywh_to_corners(bboxes[keep]), labels)
+    annotations.normalize()
+    if not job.dry_run:
+        dims = probe_image_dims(os.path.join(job.lib_path, rel_path))
+        save_to_voc_xml(rel_path, job.lib_path, job.cwd, job.database, dims, annotations, None, FILE_EXT,
+                        job.observation_rank)
+    return labels, unknown
+
+
+# Images of image_paths which have predictions, found by searching the store's sorted image ids for all their stems
+# at once
+def with_predictions(image_paths, predictions):
+    if len(image_paths) == 0 or len(predictions.image_ids) == 0:
+        return []
+    stems = np.asarray([path_stem(p) for p in image_paths], dtype=str)
+    rows = np.minimum(np.searchsorted(predictions.image_ids, stems), len(predictions.image_ids) - 1)
+    found = predictions.image_ids[rows] == stems
+    return [p for p, f in zip(image_paths, found.tolist()) if f]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be written')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    lib_path, database, pred_path, score_thresh, observation_rank, iou_thresh = load_configs()
+    classes = load_classes()
+    if not os.path.exists(lib_path):
+        raise IOError('Error: Directory specified not found. Please ensure \'LIBRARY_PATH:\' line in '
+                      '\'configurations/configs.txt\' is followed by a legitimate directory.')
+    if not os.path.exists(pred_path):
+        raise IOError('Error: Predictions not found. Please ensure \'PREDICTIONS_PATH:\' line in '
+                      '\'configurations/configs.txt\' is followed by a coco_instances_results.json file.')
+
+    start = time.perf_counter()
+    image_paths, annotation_files, _ = scan_library(lib_path, FILE_EXT, MANIFEST_FILE)
+    image_paths.sort()
+    unannotated = [p for p in image_paths if path_stem(p) + FILE_EXT not in annotation_files]
+    predictions = open_prediction_store(pred_path, score_thresh)
+    candidates = with_predictions(unannotated, predictions)
+    job = BatchJob(lib_path, database, predictions.store_dir, classes, score_thresh, iou_thresh, observation_rank,
+                   args.dry_run)
+    open_stores[predictions.store_dir] = predictions
+
+    run = partial(preannotate_image, job)
+    # Worker processes open the store themselves, so predictions only held in memory are used in this process
+    if len(candidates) >= PROCESS_POOL_MIN_FILES and predictions.store_dir is not None:
+        from concurrent.futures import ProcessPoolExecutor  # Loads multiprocessing, so only when needed
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(run, candidates, chunksize=64))
+    else:
+        results = [run(p) for p in candidates]
+
+    class_counts = Counter(label for labels, _ in results for label in labels)
+    written = sum(1 for labels, _ in results if labels)
+    print('Images in library: {}'.format(len(image_paths)))
+    print('  with {} files already (left as they are): {}'.format(FILE_EXT, len(image_paths) - len(unannotated)))
+    print('  without predictions scoring above {}: {}'.format(score_thresh, len(unannotated) - len(candidates)))
+    print('  whose predictions all score at or below {} or overlap a box in their {} by {} IoU or more: {}'.format(
+        score_thresh, PREV_ANNOT_EXT, iou_thresh, len(candidates) - written))
+    print('  {}: {} ({} boxes)'.format('to pre-annotate' if args.dry_run else 'pre-annotated', written,
+                                       sum(class_counts.values())))
+    for label, count in class_counts.most_common():
+        print('    {}: {}'.format(label, count))
+    unknown = sum(u for _, u in results)
+    if unknown:
+        print('WARNING: {} predictions have a category id with no class in classes.txt ({} classes) and were left '
+              'out'.format(unknown, len(classes)))
+    print('Done in {:.1f}s{}'.format(time.perf_counter() - start,
+                                     ' (dry run, nothing written)' if args.dry_run else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Startup import benchmark: imports each entry point and library module in a fresh interpreter with -X importtime and
+reports the total import time along with the heaviest modules it pulled in, so that a heavy dependency creeping back
+into the startup path shows up
+
+    python benchmarks/import_time.py [--repeat 5] [--top 10] [module ...]
+
+anntoolkit is replaced by an empty stub unless --real-anntoolkit is given, as it may not be installed (and its own
+import time is outside our control).
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('snappy_annotator', 'snappy_OD_suggestions', 'batch_preannotate', 'voc_save_load', 'voc_dataset',
+           'od_predictions')
+# Dependencies only some code paths need, which none of the modules should import up front
+LAZY_MODULES = ('imageio', 'cv2', 'colored', 'xml.etree.ElementTree', 'xml.sax.saxutils', 'multiprocessing')
+# Run in the child interpreter; builds the anntoolkit stub without importing anything that would skew the timings
+STUB_ANNTOOLKIT = ("import sys, types; m = types.ModuleType('anntoolkit'); m.App = type('App', (), {}); "
+                   "m.Alignment = type('Alignment', (), {'Left': 0, 'Center': 1, 'Right': 2}); "
+                   "[setattr(m, k, i) for i, k in enumerate(('KeyLeft', 'KeyRight', 'KeyUp', 'KeyDown', 'KeyDelete', "
+                   "'KeyBackspace', 'KeyEscape', 'KeyEnter', 'KeyTab', 'KeyInsert'), 256)]; "
+                   "sys.modules['anntoolkit'] = m; ")
+
+
+# Imports module in a fresh interpreter, returning {imported module: (self, cumulative) microseconds}
+def import_times(module, real_anntoolkit):
+    code = ('' if real_anntoolkit else STUB_ANNTOOLKIT) + 'import ' + module
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_DIR, stderr=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('modules', nargs='*', default=list(MODULES))
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module; the fastest is reported')
+    parser.add_argument('--top', type=int, default=10, help='number of heaviest imports listed per module')
+    parser.add_argument('--real-anntoolkit', action='store_true')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [import_times(module, args.real_anntoolkit) for _ in range(args.repeat)]
+        best = min(runs, key=lambda times: times[module][1])
+        print('{}: {:.1f} ms (fastest of {}, median {:.1f} ms)'.format(
+            module, best[module][1] / 1e3, args.repeat,
+            sorted(times[module][1] for times in runs)[len(runs) // 2] / 1e3))
+        # Only top-level packages are listed, their submodules being included in their cumulative times
+        heaviest = sorted((name for name in best if '.' not in name and name != module),
+                          key=lambda name: -best[name][1])[:args.top]
+        for name in heaviest:
+            print('  {:<32}{:>10.1f} ms'.format(name, best[name][1] / 1e3))
+        eager = [name for name in LAZY_MODULES if name in best]
+        if eager:
+            print('  imported up front, but only needed on some code paths: {}'.format(', '.join(eager)))
+
+
+if __name__ == '__main__':
+    main()
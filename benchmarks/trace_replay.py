@@ -0,0 +1,361 @@
+"""
+Headless benchmark of the annotator apps: replays a trace of input events against snappy_annotator.App and
+snappy_OD_suggestions.App, with a stub standing in for anntoolkit's window, over a generated image library, and
+reports latency percentiles per event type, startup time and peak memory
+
+    python benchmarks/trace_replay.py [--images 500] [--events 5000] [--apps snappy_annotator ...]
+
+Traces are JSON-lines files with one event per line, as a list of the event type followed by its arguments:
+    ["key", "KeyRight"]              on_keyboard (anntoolkit key constants by name, other keys as characters)
+    ["button", true, 120.5, 80.0]    on_mouse_button, pressed or released at image position (x, y)
+    ["position", 130.0, 95.5]        on_mouse_position, at image position (x, y)
+    ["update"]                       on_update, i.e. one frame
+A synthetic trace is generated unless one is given with --trace; --save-trace keeps the trace that was used.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from functools import partial
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ('snappy_annotator', 'snappy_OD_suggestions')
+CLASSES = ('leaf', 'flower', 'fruit', 'stem', 'entire')
+CONTENTS = ('Leaf', 'Flower', 'Fruit', 'Stem', 'Entire', 'LeafScan')
+SPECIES_COUNT = 40
+IMAGES_PER_DIR = 1000
+KEY_NAMES = ('KeyLeft', 'KeyRight', 'KeyUp', 'KeyDown', 'KeyDelete', 'KeyBackspace', 'KeyEscape', 'KeyEnter',
+             'KeyTab', 'KeyInsert')
+PERCENTILES = (50, 95, 99)
+
+
+# Stands in for the anntoolkit module: App opens no window, drawing calls do nothing and run() returns immediately
+def make_stub_anntoolkit():
+    stub = types.ModuleType('anntoolkit')
+    for code, name in enumerate(KEY_NAMES, 256):
+        setattr(stub, name, code)
+
+    class Alignment:
+        Left, Center, Right = range(3)
+
+    class App:
+        def __init__(self, width=1280, height=960, title=''):
+            self.width = width
+            self.height = height
+            self.scale = 1.0
+            self.title = title
+            self.image = None
+
+        def set_image(self, image, recenter=True):
+            self.image = image
+
+        def set_roi(self, roi, scale=None):
+            pass
+
+        def text(self, *args, **kwargs):
+            pass
+
+        def text_loc(self, *args, **kwargs):
+            pass
+
+        def point(self, *args, **kwargs):
+            pass
+
+        def box(self, *args, **kwargs):
+            pass
+
+        def run(self):
+            pass
+
+    stub.Alignment = Alignment
+    stub.App = App
+    return stub
+
+
+# Writes a PlantCLEF-style library of noise images with metadata xmls into lib_dir, annotating annotated_fraction of
+# them, and returns COCO-format predictions for all images, as object detection results would be
+def make_library(lib_dir, images, size, annotated_fraction, seed):
+    from PIL import Image
+    from voc_save_load import voc_xml_string
+
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    width, height = size
+    # Smooth noise compresses like a photo far more than white noise does
+    base = np_rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    predictions = []
+    for i in range(images):
+        rel_dir = 'batch{:03d}'.format(i // IMAGES_PER_DIR)
+        os.makedirs(os.path.join(lib_dir, rel_dir), exist_ok=True)
+        stem = os.path.join(rel_dir, 'img{:06d}'.format(i))
+        shift = np_rng.integers(0, 64, 3, dtype=np.uint8)
+        im = Image.fromarray(np.roll(base, i, axis=1) + shift).resize((width, height), Image.BILINEAR)
+        im.save(os.path.join(lib_dir, stem + '.jpg'), quality=85)
+        with open(os.path.join(lib_dir, stem + '.xml'), 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<Image>\n'
+                    '  <Content>{}</Content>\n  <Species>Species {}</Species>\n</Image>\n'.format(
+                        rng.choice(CONTENTS), rng.randrange(SPECIES_COUNT)))
+
+        boxes = []
+        for _ in range(rng.randint(1, 8)):
+            x0, y0 = rng.uniform(0, width * 0.8), rng.uniform(0, height * 0.8)
+            x1, y1 = rng.uniform(x0 + 10, width), rng.uniform(y0 + 10, height)
+            boxes.append((x0, y0, x1, y1))
+            predictions.append({'image_id': stem, 'category_id': rng.randint(1, len(CLASSES)),
+                                'bbox': [x0, y0, x1 - x0, y1 - y0], 'score': rng.random()})
+        if rng.random() < annotated_fraction:
+            annotations = []
+            for x0, y0, x1, y1 in boxes:
+                annotations += [(int(x0), int(y0)), (int(x1), int(y1))]
+            with open(os.path.join(lib_dir, stem + '_annotations.xml'), 'w') as f:
+                f.write(voc_xml_string(os.path.basename(stem) + '.jpg', lib_dir, '', 'Synthetic', (height, width, 3),
+                                       annotations, [rng.choice(CLASSES) for _ in boxes], 0))
+    return predictions
+
+
+# Sets up the configurations folder the apps read from the working directory
+def write_configurations(work_dir, lib_dir, predictions_path):
+    os.makedirs(os.path.join(work_dir, 'configurations'), exist_ok=True)
+    with open(os.path.join(work_dir, 'configurations', 'configs.txt'), 'w') as f:
+        f.write('LIBRARY_PATH:{}\nDATABASE:Synthetic\nDEF_LABEL:{}\nSORT_BY_SPECIES:True\nDB_CHANGED:False\n'
+                'SNAPPY_OBSERVATION_RANK:0\nOD_OBSERVATION_RANK:1\nPREDICTIONS_PATH:{}\nPREDICTION_THRESH:0.5\n'
+                .format(lib_dir, CLASSES[0], predictions_path))
+    with open(os.path.join(work_dir, 'configurations', 'classes.txt'), 'w') as f:
+        f.write('\n'.join(CLASSES) + '\n')
+
+
+# A made-up annotation session: mostly drawing boxes and moving around them, with relabelling, selecting, removing
+# and moving between images mixed in, and a frame drawn after every input event
+def synthetic_trace(events, size, seed):
+    rng = random.Random(seed)
+    width, height = size
+    trace = []
+
+    def point():
+        return [round(rng.uniform(0, width), 1), round(rng.uniform(0, height), 1)]
+
+    def move(start, end, steps):
+        for s in range(1, steps + 1):
+            trace.append(['position'] + [round(a + (b - a) * s / steps, 1) for a, b in zip(start, end)])
+            trace.append(['update'])
+
+    def click(at):
+        for down in (True, False):
+            trace.append(['button', down] + at)
+            trace.append(['update'])
+
+    position = point()
+    while len(trace) < events:
+        action = rng.random()
+        if action < 0.15:
+            key = rng.choice(('KeyRight', 'KeyRight', 'KeyRight', 'KeyLeft', 'KeyUp', 'KeyDown', '.', ','))
+            trace += [['key', key], ['update']]
+        elif action < 0.5:
+            # Draws a box
+            start, end = point(), point()
+            move(position, start, rng.randint(2, 8))
+            click(start)
+            move(start, end, rng.randint(4, 16))
+            click(end)
+            position = end
+        elif action < 0.75:
+            # Hovers around
+            target = point()
+            move(position, target, rng.randint(5, 20))
+            position = target
+        elif action < 0.85:
+            # Drags whatever is under the cursor
+            target = point()
+            trace += [['button', True] + position, ['update']]
+            move(position, target, rng.randint(4, 16))
+            trace += [['button', False] + target, ['update']]
+            position = target
+        else:
+            key = rng.choice(('1', '2', '3', '4', 'Q', 'E', 'T', 'KeyBackspace'))
+            trace += [['key', key], ['update']]
+    return trace[:events]
+
+
+def save_trace(trace, path):
+    with open(path, 'w') as f:
+        for event in trace:
+            f.write(json.dumps(event) + '\n')
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# Latency percentiles (in seconds) of each list of timings
+def summarize(timings):
+    summary = {}
+    for name, times in sorted(timings.items()):
+        times = np.asarray(times)
+        summary[name] = {'count': len(times), 'total': float(times.sum()), 'max': float(times.max())}
+        for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+            summary[name]['p{}'.format(p)] = float(value)
+    return summary
+
+
+# Replays trace against app, timing every event, both per event type and, for keys, per key
+def replay(app, trace, anntoolkit):
+    timings = {}
+    errors = {}
+    for event in trace:
+        kind, args = event[0], event[1:]
+        if kind == 'key':
+            key = getattr(anntoolkit, args[0]) if args[0] in KEY_NAMES else args[0]
+            call = partial(app.on_keyboard, key, True, 0)
+            names = ('on_keyboard', 'on_keyboard ' + args[0])
+        elif kind == 'button':
+            call = partial(app.on_mouse_button, args[0], args[1], args[2], args[1], args[2])
+            names = ('on_mouse_button',)
+        elif kind == 'position':
+            call = partial(app.on_mouse_position, args[0], args[1], args[0], args[1])
+            names = ('on_mouse_position',)
+        elif kind == 'update':
+            call = app.on_update
+            names = ('on_update',)
+        else:
+            raise ValueError('Unknown event type in trace: {}'.format(kind))
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception as e:  # The app would have crashed; counted, so that the rest of the trace still runs
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+        elapsed = time.perf_counter() - start
+        for name in names:
+            timings.setdefault(name, []).append(elapsed)
+    return timings, errors
+
+
+# Runs one app over a trace within this process, which is started by run_app with the working directory set up
+def child_main(app_name, trace_path, result_path):
+    anntoolkit = make_stub_anntoolkit()
+    sys.modules['anntoolkit'] = anntoolkit
+    sys.path.insert(0, REPO_DIR)
+    trace = load_trace(trace_path)
+
+    start = time.perf_counter()
+    module = __import__(app_name)
+    import_time = time.perf_counter() - start
+    start = time.perf_counter()
+    app = module.App()
+    startup_time = time.perf_counter() - start
+    timings, errors = replay(app, trace, anntoolkit)
+    start = time.perf_counter()
+    app.run()  # Returns at once with the stub; closes the app down, waiting for pending saves
+    shutdown_time = time.perf_counter() - start
+
+    with open(result_path, 'w') as f:
+        json.dump({'app': app_name, 'import_time': import_time, 'startup_time': startup_time,
+                   'shutdown_time': shutdown_time, 'peak_rss': peak_rss(), 'events': summarize(timings),
+                   'errors': errors}, f)
+
+
+# Runs an app in a process of its own, so that its startup and peak memory are measured in isolation, on a private
+# copy of the library since the trace edits annotations
+def run_app(app_name, base_dir, lib_dir, predictions_path, trace_path, verbose):
+    run_dir = os.path.join(base_dir, app_name)
+    run_lib = os.path.join(run_dir, 'library')
+    shutil.copytree(lib_dir, run_lib)
+    write_configurations(run_dir, run_lib, predictions_path)
+    result_path = os.path.join(run_dir, 'result.json')
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--child', app_name, '--trace', trace_path,
+                    '--result', result_path], cwd=run_dir, check=True,
+                   stdout=None if verbose else subprocess.DEVNULL)
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def print_result(result):
+    rss = result['peak_rss']
+    print('{}: import {:.2f} s, startup {:.2f} s, shutdown {:.2f} s, peak RSS {}'.format(
+        result['app'], result['import_time'], result['startup_time'], result['shutdown_time'],
+        '{:.0f} MB'.format(rss / 1024 ** 2) if rss is not None else 'n/a'))
+    header = '  {:<28}{:>8}' + '{:>10}' * (len(PERCENTILES) + 1)
+    print(header.format('event', 'count', *['p{} ms'.format(p) for p in PERCENTILES], 'max ms'))
+    for name, stats in result['events'].items():
+        print(header.format(name, stats['count'], *['{:.3f}'.format(stats['p{}'.format(p)] * 1e3) for p in PERCENTILES],
+                            '{:.3f}'.format(stats['max'] * 1e3)))
+    if result['errors']:
+        print('  errors raised by event handlers: {}'.format(result['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--apps', nargs='+', default=list(APPS), choices=APPS)
+    parser.add_argument('--images', type=int, default=500, help='number of images in the generated library')
+    parser.add_argument('--image-size', type=int, nargs=2, default=(1600, 1200), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--annotated', type=float, default=0.3, help='fraction of images with annotations')
+    parser.add_argument('--events', type=int, default=5000, help='length of the synthetic trace')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', help='replay this trace file instead of a synthetic one')
+    parser.add_argument('--save-trace', help='write the replayed trace to this file')
+    parser.add_argument('--output', help='also write the results to this file, as json')
+    parser.add_argument('--keep', action='store_true', help='keep the generated library and working directories')
+    parser.add_argument('--verbose', action='store_true', help="show the apps' own output")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child_main(args.child, args.trace, args.result)
+        return
+
+    base_dir = tempfile.mkdtemp(prefix='snappy_benchmark_')
+    try:
+        sys.path.insert(0, REPO_DIR)
+        lib_dir = os.path.join(base_dir, 'library')
+        start = time.perf_counter()
+        predictions = make_library(lib_dir, args.images, args.image_size, args.annotated, args.seed)
+        predictions_path = os.path.join(base_dir, 'coco_instances_results.json')
+        with open(predictions_path, 'w') as f:
+            json.dump(predictions, f)
+        print('Generated {} images of {}x{} in {:.1f} s'.format(args.images, *args.image_size,
+                                                               time.perf_counter() - start))
+
+        trace_path = args.trace or os.path.join(base_dir, 'trace.jsonl')
+        if not args.trace:
+            save_trace(synthetic_trace(args.events, args.image_size, args.seed), trace_path)
+        if args.save_trace:
+            shutil.copyfile(trace_path, args.save_trace)
+
+        results = []
+        for app_name in args.apps:
+            results.append(run_app(app_name, base_dir, lib_dir, predictions_path, trace_path, args.verbose))
+            print_result(results[-1])
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'images': args.images, 'image_size': args.image_size, 'results': results}, f, indent=1)
+    finally:
+        if args.keep:
+            print('Kept {}'.format(base_dir))
+        else:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
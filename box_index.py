@@ -0,0 +1,111 @@
+"""
+Spatial index over the bounding boxes of an image, for finding the box and corner under the mouse cursor without
+going through every box on each mouse move
+"""
+
+import numpy as np
+
+# Average number of boxes per grid cell that the grid resolution is chosen for
+BOXES_PER_CELL = 4
+
+
+# Uniform grid over a set of rectangles (N x 4 array of xmin, ymin, xmax, ymax), listing each rectangle in every cell
+# it overlaps. Cells are numbered row by row, and the rectangles in cell c are members[offsets[c]:offsets[c + 1]].
+class UniformGrid:
+    def __init__(self, rects, per_cell=BOXES_PER_CELL):
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        self.cell_size = 1.0
+        if len(rects) == 0:
+            self.origin = np.zeros(2)
+            self.shape = np.ones(2, dtype=np.int64)
+            self.members = np.zeros(0, dtype=np.int64)
+            self.offsets = np.zeros(2, dtype=np.int64)
+            return
+        self.origin = rects[:, :2].min(axis=0)
+        extent = (rects[:, 2:].max(axis=0) - self.origin).max()
+        self.cell_size = max(extent / np.ceil(np.sqrt(len(rects) / per_cell)), 1.0)
+        first = self.cell_of(rects[:, :2])
+        last = self.cell_of(rects[:, 2:])
+        self.shape = last.max(axis=0) + 1
+        spans = last - first + 1
+        counts = spans[:, 0] * spans[:, 1]
+        rect_ids = np.repeat(np.arange(len(rects)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = first[rect_ids, 0] + local % spans[rect_ids, 0]
+        cell_y = first[rect_ids, 1] + local // spans[rect_ids, 0]
+        cells = cell_y * self.shape[0] + cell_x
+        self.members = rect_ids[np.argsort(cells, kind='stable')]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=int(np.prod(self.shape))))])
+
+    def cell_of(self, xy):
+        return np.floor((np.asarray(xy, dtype=np.float64) - self.origin) / self.cell_size).astype(np.int64)
+
+    # Indices, in ascending order, of the rectangles listed in any cell overlapping the query rectangle. These are
+    # only candidates: they still need to be tested against the query itself.
+    def candidates(self, xmin, ymin, xmax, ymax):
+        first = self.cell_of((xmin, ymin))
+        last = self.cell_of((xmax, ymax))
+        if (last < 0).any() or (first >= self.shape).any():
+            return self.members[:0]
+        first = np.maximum(first, 0)
+        last = np.minimum(last, self.shape - 1)
+        # Cells of one grid row are consecutive, so each row of the query is a single slice of members
+        rows = [self.members[self.offsets[y * self.shape[0] + first[0]]:self.offsets[y * self.shape[0] + last[0] + 1]]
+                for y in range(first[1], last[1] + 1)]
+        return np.unique(np.concatenate(rows))
+
+
+# Hit-testing over the boxes and corners of an AnnotationStore. Built once per change of the annotations, see
+# matches().
+class BoxIndex:
+    def __init__(self, annotations):
+        self.version = annotations.version
+        self.points = annotations.points()
+        corners = annotations.boxes
+        self.boxes = np.concatenate([np.minimum(corners[:, :2], corners[:, 2:]),
+                                     np.maximum(corners[:, :2], corners[:, 2:])], axis=1)
+        self.areas = (self.boxes[:, 2] - self.boxes[:, 0]) * (self.boxes[:, 3] - self.boxes[:, 1])
+        # Points of the two corners each box doesn't store: (x0, y1), then (x1, y0)
+        self.opposite_corners = corners[:, [0, 3, 2, 1]].reshape(-1, 2)
+        self.corners = np.concatenate([self.points, self.opposite_corners])
+        self.box_grid = UniformGrid(self.boxes)
+        self.corner_grid = UniformGrid(np.concatenate([self.corners, self.corners], axis=1))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    # Whether the index is still up to date with annotations
+    def matches(self, annotations):
+        return self.version == annotations.version
+
+    # Index of the smallest box containing (x, y), borders included, or -1 if there is none. Ties go to the box
+    # drawn first.
+    def box_at(self, x, y):
+        candidates = self.box_grid.candidates(x, y, x, y)
+        boxes = self.boxes[candidates]
+        inside = (boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])
+        if not inside.any():
+            return -1
+        candidates = candidates[inside]
+        return int(candidates[np.argmin(self.areas[candidates])])
+
+    # Nearest corner closer than radius to (x, y), as (index, opposite): with opposite False, index is a point of the
+    # store, otherwise into the opposite corners (two per box, so index // 2 is the box). At equal distance, opposite
+    # corners win over annotation points. Returns None if no corner is close enough.
+    def nearest_corner(self, x, y, radius):
+        candidates = self.corner_grid.candidates(x - radius, y - radius, x + radius, y + radius)
+        if len(candidates) == 0:
+            return None
+        corners = self.corners[candidates]
+        dist = np.hypot(corners[:, 0] - x, corners[:, 1] - y)
+        dist[dist >= radius] = np.inf
+        is_point = candidates < len(self.points)
+        point_dist = np.where(is_point, dist, np.inf)
+        opposite_dist = np.where(is_point, np.inf, dist)
+        ind_p = np.argmin(point_dist)
+        ind_op = np.argmin(opposite_dist)
+        if point_dist[ind_p] < opposite_dist[ind_op]:
+            return int(candidates[ind_p]), False
+        if opposite_dist[ind_op] < np.inf:
+            return int(candidates[ind_op]) - len(self.points), True
+        return None
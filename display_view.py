@@ -0,0 +1,61 @@
+"""
+Mapping between the pixels of the original image, which annotations are always kept and saved in, and the pixels of
+the image actually handed to the window: the whole image at a reduced resolution, or a full-resolution region of it
+"""
+
+import numpy as np
+
+# Longest side of the full-resolution region shown in detail view, in pixels
+DETAIL_SIDE = 2048
+
+
+# Displayed pixel (u, v) is original pixel (u * scale[0] + offset[0], v * scale[1] + offset[1]). Views are never
+# changed once made, so one can stand for the drawing done over it.
+class DisplayView:
+    def __init__(self, scale=(1.0, 1.0), offset=(0.0, 0.0), detail=False):
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.detail = detail
+        self.identity = bool((self.scale == 1).all() and (self.offset == 0).all())
+
+    # View of a whole image with the given (height, width, depth), displayed as the decoded image im
+    @classmethod
+    def for_image(cls, dims, im):
+        return cls((dims[1] / im.shape[1], dims[0] / im.shape[0]))
+
+    # View of the full-resolution region (xmin, ymin, xmax, ymax) of an image
+    @classmethod
+    def for_region(cls, region):
+        return cls((1.0, 1.0), region[:2], detail=True)
+
+    # Whether the image is displayed at less than its full resolution
+    def reduced(self):
+        return bool((self.scale > 1).any())
+
+    # Size of one displayed pixel in original pixels
+    def pixel_size(self):
+        return float(self.scale.max())
+
+    def to_image(self, x, y):
+        if self.identity:
+            return x, y
+        return x * float(self.scale[0]) + float(self.offset[0]), y * float(self.scale[1]) + float(self.offset[1])
+
+    # Maps an N x 2 array of original image points to displayed pixels
+    def to_display(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.identity:
+            return points
+        return (points - self.offset) / self.scale
+
+
+# Region of at most side x side original pixels to show in detail, centered on the part of the image in view
+# (visible, as xmin, ymin, xmax, ymax in original pixels) and kept within the image's width and height
+def detail_region(visible, width, height, side=DETAIL_SIDE):
+    center_x = (visible[0] + visible[2]) / 2
+    center_y = (visible[1] + visible[3]) / 2
+    region_w = min(side, width)
+    region_h = min(side, height)
+    x0 = int(round(min(max(0, center_x - region_w / 2), width - region_w)))
+    y0 = int(round(min(max(0, center_y - region_h / 2), height - region_h)))
+    return x0, y0, x0 + region_w, y0 + region_h
@@ -0,0 +1,18 @@
+"""
+Recorded drawing calls, so that frames which look the same as the last one are drawn without working them out again
+"""
+
+
+# Drawing calls (e.g. an App's text, point and box methods with their arguments) in the order they are to be made,
+# along with the key describing the state they were recorded from; the list is only valid while that key is current
+class DrawList:
+    def __init__(self, key):
+        self.key = key
+        self.calls = []
+
+    def add(self, draw, *args, **kwargs):
+        self.calls.append((draw, args, kwargs))
+
+    def replay(self):
+        for draw, args, kwargs in self.calls:
+            draw(*args, **kwargs)
@@ -0,0 +1,345 @@
+"""
+Background decoding and in-memory caching of images, so that moving between neighbouring images does not wait on a
+decode
+"""
+
+import os
+import time
+import shutil
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+# Longest side, in pixels, that images are decoded at for display. Larger images (e.g. gigapixel herbarium scans) are
+# decoded at a reduced resolution, and only shown at full resolution a region at a time (see decode_region).
+MAX_DISPLAY_SIDE = 4096
+# Full-resolution copies of images made for decode_region, and the disk space they may take up altogether
+REGION_CACHE_DIR = os.path.join('configurations', 'regions')
+REGION_CACHE_BYTES = 8 * 1024 ** 3
+# Disk space left free when making a copy
+REGION_CACHE_FREE_BYTES = 1024 ** 3
+# Temporary files of copies which haven't been written to for this long, in seconds, were left by interrupted copies
+REGION_TMP_MAX_AGE = 600
+# Largest image, in pixels, that this module opens (see open_image)
+MAX_IMAGE_PIXELS = 2 ** 32
+# Rows copied at a time when saving a full-resolution copy
+REGION_COPY_ROWS = 512
+# Bands of the image modes whose uncompressed pixels can be memory-mapped as they are, at one byte per band
+RAW_BANDS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+
+# Opens the image at path as Image.open does, except that its size, read from the header, is checked against
+# max_pixels rather than PIL's decompression bomb limit. Gigapixel scans are well beyond PIL's limit, but as that is a
+# process-wide setting (Image.MAX_IMAGE_PIXELS), it is left in place for any other code opening images. Raises OSError
+# (UnidentifiedImageError) for files no PIL plugin recognises, and Image.DecompressionBombError for images over
+# max_pixels.
+def open_image(path, max_pixels=MAX_IMAGE_PIXELS):
+    with open(path, 'rb') as f:
+        prefix = f.read(16)
+    Image.preinit()
+    for load_all_plugins in (False, True):
+        if load_all_plugins:
+            Image.init()
+        for format_id in list(Image.ID):
+            factory, accept = Image.OPEN[format_id]
+            accepted = not accept or accept(prefix)
+            if not accepted or isinstance(accepted, str):
+                continue
+            try:
+                im = factory(path, path)
+            except (SyntaxError, IndexError, TypeError, struct.error):  # As Image.open, tries the next plugin
+                continue
+            width, height = im.size
+            if width * height > max_pixels:
+                im.close()
+                raise Image.DecompressionBombError('{} is {} pixels, more than the limit of {}'.format(
+                    path, width * height, max_pixels))
+            return im
+    raise UnidentifiedImageError('cannot identify image file {!r}'.format(path))
+
+
+# Returns (height, width, depth) of a decoded image, matching the layout of numpy/OpenCV image shapes
+def frame_dims(im):
+    return im.shape[0], im.shape[1], im.shape[2] if im.ndim == 3 else 1
+
+
+# Returns (height, width, depth) of the image at path by reading only its header; no pixel data is decoded.
+# Palette images are reported with the depth of the RGB image they decode to.
+def probe_image_dims(path):
+    with open_image(path) as im:
+        width, height = im.size
+        depth = 3 if im.mode == 'P' else len(im.getbands())
+    return height, width, depth
+
+
+# Converts palette images to RGB, as imageio does when decoding them
+def display_mode(im):
+    return im.convert('RGB') if im.mode == 'P' else im
+
+
+# Decodes the image at path for display, returning the decoded image and the (height, width, depth) of the original.
+# Images with a side longer than max_side are decoded at a reduced resolution which fits max_side; for JPEGs, most of
+# the reduction is done by DCT scaling while decoding, so the full-resolution image is never held in memory.
+# Files which can't be decoded (missing, truncated, or not images at all) raise ValueError, as imageio does for files
+# it doesn't recognise, which is what the apps skip such images on.
+def decode_image(path, max_side=MAX_DISPLAY_SIDE):
+    try:
+        with open_image(path) as im:
+            width, height = im.size
+            depth = 3 if im.mode == 'P' else len(im.getbands())
+            if max(width, height) > max_side:
+                # A reducing_gap of 1 lets the JPEG decoder scale down as far as the target size allows
+                im.thumbnail((max_side, max_side), reducing_gap=1.0)
+                return np.asarray(display_mode(im)), (height, width, depth)
+        import imageio  # Imported on first use, so that importing this module stays cheap
+        im = imageio.imread(path)
+    except (OSError, Image.DecompressionBombError) as e:  # OSError includes PIL's UnidentifiedImageError
+        raise ValueError('Could not decode {}: {}'.format(path, e)) from e
+    return im, frame_dims(im)
+
+
+# The pixels of an image stored uncompressed as one block (e.g. uncompressed TIFF, PPM), memory-mapped from the image
+# file itself, or None for any other image
+def map_raw_pixels(path, im):
+    if len(im.tile) != 1 or im.mode not in RAW_BANDS:
+        return None
+    codec, extents, offset, args = im.tile[0][:4]
+    args = args if isinstance(args, tuple) else (args,)
+    width, height = im.size
+    bands = RAW_BANDS[im.mode]
+    if codec != 'raw' or tuple(extents) != (0, 0, width, height) or args[0] != im.mode or \
+            (len(args) > 1 and args[1] not in (0, width * bands)) or (len(args) > 2 and args[2] != 1):
+        return None
+    shape = (height, width, bands) if bands > 1 else (height, width)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=shape)
+
+
+# Where the full-resolution copy of the image at path is kept, named by a hash of the image's absolute path and
+# modification time, as thumbnails are
+def region_cache_path(path, cache_dir=REGION_CACHE_DIR):
+    key = '{}\n{}'.format(os.path.abspath(path), os.stat(path).st_mtime_ns)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# The copies in cache_dir as (path, size) pairs, least recently used first. Temporary files left behind by
+# interrupted copies are deleted on the way.
+def region_copies(cache_dir):
+    copies = []
+    now = time.time()
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.tmp.npy'):
+            if now - entry.stat().st_mtime > REGION_TMP_MAX_AGE:
+                remove_file(entry.path)
+        elif entry.name.endswith('.npy'):
+            st = entry.stat()
+            copies.append((st.st_mtime, entry.path, st.st_size))
+    return [(p, size) for _, p, size in sorted(copies)]
+
+
+# Deletes the least recently used copies in cache_dir until a new one of size bytes fits within max_bytes. Returns
+# False, deleting nothing, if it never could, and also if the copy would leave less than REGION_CACHE_FREE_BYTES free
+# on the disk.
+def make_room_for_copy(cache_dir, size, max_bytes):
+    if size > max_bytes:
+        return False
+    copies = region_copies(cache_dir)
+    total = sum(s for _, s in copies)
+    for old, old_size in copies:
+        if total + size <= max_bytes:
+            break
+        remove_file(old)
+        total -= old_size
+    return shutil.disk_usage(cache_dir).free - size >= REGION_CACHE_FREE_BYTES
+
+
+# Decodes the image at path once and saves it, as decoded for display, as an uncompressed .npy file at copy_path. Rows
+# are copied a strip at a time, so the decoded image is only held once. The least recently used copies in the same
+# directory are deleted to keep them all within max_bytes. Returns False if there is no room for the copy (or it
+# couldn't be written), in which case nothing is saved.
+def save_region_copy(path, copy_path, max_bytes=REGION_CACHE_BYTES):
+    cache_dir = os.path.dirname(copy_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = copy_path + '.tmp.npy'
+    try:
+        with open_image(path) as im:
+            width, height = im.size
+            strip = np.asarray(display_mode(im.crop((0, 0, width, min(REGION_COPY_ROWS, height)))))
+            if not make_room_for_copy(cache_dir, strip.nbytes // len(strip) * height, max_bytes):
+                print('WARNING: No room in {} for a full-resolution copy of {}; regions of it are decoded from the '
+                      'whole image each time'.format(cache_dir, path))
+                return False
+            with open(tmp_path, 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(strip.dtype),
+                                                         'fortran_order': False,
+                                                         'shape': (height,) + strip.shape[1:]})
+                f.write(strip.tobytes())
+                for y in range(len(strip), height, REGION_COPY_ROWS):
+                    f.write(np.asarray(display_mode(im.crop((0, y, width,
+                                                             min(y + REGION_COPY_ROWS, height))))).tobytes())
+        os.replace(tmp_path, copy_path)
+    except OSError as e:
+        remove_file(tmp_path)
+        print('WARNING: Could not save a full-resolution copy of {}: {}'.format(path, e))
+        return False
+    return True
+
+
+# Decodes the (xmin, ymin, xmax, ymax) region of the image at path at full resolution. Uncompressed images are read
+# straight from the file, touching only the region's pixels. Any other image is decoded in full once, into a
+# full-resolution copy in cache_dir (see save_region_copy), from which regions are then read the same way, so moving
+# around a large image only decodes it the first time. Without room for the copy, the region is cut out of a full
+# decode of the image every time.
+def decode_region(path, region, cache_dir=REGION_CACHE_DIR, max_bytes=REGION_CACHE_BYTES):
+    xmin, ymin, xmax, ymax = [int(v) for v in region]
+    with open_image(path) as im:
+        pixels = map_raw_pixels(path, im)
+        if pixels is not None:
+            return np.array(pixels[ymin:ymax, xmin:xmax])
+    copy_path = region_cache_path(path, cache_dir)
+    if os.path.exists(copy_path):
+        os.utime(copy_path)
+    elif not save_region_copy(path, copy_path, max_bytes):
+        with open_image(path) as im:
+            return np.asarray(display_mode(im.crop((xmin, ymin, xmax, ymax))))
+    return np.array(np.load(copy_path, mmap_mode='r')[ymin:ymax, xmin:xmax])
+
+
+# Holds decoded images in least-recently-used order within a byte budget. Images that are likely to be viewed next
+# are decoded ahead of time on a pool of worker threads through prefetch(), and get() returns them without decoding
+# on the calling (UI) thread whenever they are already available. Images are held as decoded for display, so large
+# ones at a reduced resolution; image_dims always gives the dimensions of the original.
+class ImageCache:
+    def __init__(self, max_bytes=1024 ** 3, workers=2, max_side=MAX_DISPLAY_SIDE):
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.cached_bytes = 0
+        self.images = OrderedDict()
+        self.pending = {}
+        self.dims = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Counters, readable at any time to judge how well prefetching keeps up with navigation
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+        self.decode_time = 0.0
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    @property
+    def mean_decode_time(self):
+        return self.decode_time / self.decoded if self.decoded else 0.0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'decoded': self.decoded,
+                    'decode_time': self.decode_time, 'mean_decode_time': self.mean_decode_time,
+                    'cached_images': len(self.images), 'cached_bytes': self.cached_bytes}
+
+    def decode(self, path):
+        start = time.perf_counter()
+        im, dims = decode_image(path, self.max_side)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.dims[path] = dims
+            self.decoded += 1
+            self.decode_time += elapsed
+        return im
+
+    # Adds a decoded image to the cache, evicting the least recently used images until the byte budget is met.
+    # Images which would not fit in the budget on their own are not cached at all.
+    def store(self, path, im):
+        with self.lock:
+            if im.nbytes > self.max_bytes or path in self.images:
+                return
+            self.images[path] = im
+            self.cached_bytes += im.nbytes
+            while self.cached_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.cached_bytes -= evicted.nbytes
+
+    # Returns the decoded image at path. Waits on an in-flight background decode of the same image rather than
+    # decoding it a second time, and only decodes on the calling thread if the image was never requested before.
+    def get(self, path):
+        with self.lock:
+            if path in self.images:
+                self.images.move_to_end(path)
+                self.hits += 1
+                return self.images[path]
+            future = self.pending.get(path)
+            if future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            return future.result()
+        im = self.decode(path)
+        self.store(path, im)
+        return im
+
+    # Queues background decodes for the given paths (in order of priority). Queued decodes of paths which are no
+    # longer wanted are cancelled if they haven't started yet, so holding down a navigation key doesn't build a backlog.
+    def prefetch(self, paths):
+        wanted = set(paths)
+        with self.lock:
+            for path, future in list(self.pending.items()):
+                if path not in wanted and future.cancel():
+                    del self.pending[path]
+            for path in paths:
+                if path in self.images or path in self.pending:
+                    continue
+                self.pending[path] = self.pool.submit(self.prefetch_worker, path)
+
+    def prefetch_worker(self, path):
+        try:
+            im = self.decode(path)
+            self.store(path, im)
+            return im
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    # Returns (height, width, depth) of the image at path without touching pixel data: dimensions are remembered
+    # from any earlier decode of the image, otherwise taken from the (width, height, depth) recorded in its VOC file
+    # when given, and only otherwise read from the image file header. Results are memoized per path.
+    def image_dims(self, path, xml_dims=()):
+        with self.lock:
+            dims = self.dims.get(path)
+        if dims is None:
+            if xml_dims:
+                dims = (xml_dims[1], xml_dims[0], xml_dims[2])
+            else:
+                dims = probe_image_dims(path)
+            with self.lock:
+                dims = self.dims.setdefault(path, dims)
+        return dims
+
+    # Removes an image from the cache, e.g. when the file on disk has been replaced
+    def invalidate(self, path):
+        with self.lock:
+            im = self.images.pop(path, None)
+            if im is not None:
+                self.cached_bytes -= im.nbytes
+            self.dims.pop(path, None)
+
+    def close(self):
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.pool.shutdown(wait=False)
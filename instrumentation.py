@@ -0,0 +1,150 @@
+"""
+Opt-in timing of the annotators' main operations (loading images, reading annotations and metadata, saving and
+rendering), shown as an on-screen overlay and dumped periodically as JSON lines, so that sessions on different
+workstations and dataset mounts can be compared
+"""
+
+import os
+import json
+import time
+import platform
+from collections import deque
+from contextlib import nullcontext
+from functools import wraps
+
+import numpy as np
+
+# Number of most recent timings of each operation which the percentiles are taken over
+STATS_WINDOW = 500
+STATS_PERCENTILES = (50, 95, 99)
+# Seconds between two dumps of the stats to the stats file
+DUMP_INTERVAL = 60.0
+DEFAULT_STATS_PATH = os.path.join('configurations', 'stats.jsonl')
+
+
+# Timings of one operation: call count and total time over the whole session, and the durations of the most recent
+# calls. Also usable as a context manager timing its block (not reentrant).
+class Timer:
+    def __init__(self, window=STATS_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+        self.start = None
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.recent.append(elapsed)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.add(time.perf_counter() - self.start)
+
+    # Count and total over the session, with the percentiles and maximum of the recent calls, all times in ms
+    def summary(self):
+        summary = {'count': self.count, 'total_ms': self.total * 1e3}
+        if self.recent:
+            recent = np.asarray(self.recent) * 1e3
+            for p, value in zip(STATS_PERCENTILES, np.percentile(recent, STATS_PERCENTILES)):
+                summary['p{}_ms'.format(p)] = float(value)
+            summary['max_ms'] = float(recent.max())
+        return summary
+
+
+# Timers for named operations plus counter sources (functions returning a dict, e.g. ImageCache.stats), which are
+# appended to stats_path as one JSON object per line at most every dump_interval seconds
+class Instrumentation:
+    def __init__(self, stats_path=DEFAULT_STATS_PATH, dump_interval=DUMP_INTERVAL):
+        self.stats_path = stats_path
+        self.dump_interval = dump_interval
+        self.timers = {}
+        self.counters = {}
+        self.session = {'host': platform.node(), 'pid': os.getpid(), 'started': time.time()}
+        self.last_dump = time.monotonic()
+
+    def timer(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        return timer
+
+    # Returns func wrapped to time each of its calls as the named operation
+    def timed(self, name, func):
+        timer = self.timer(name)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.add(time.perf_counter() - start)
+        return wrapper
+
+    # Times the named methods of obj from now on, by shadowing each with a timed wrapper on the instance itself, so
+    # nothing is added to the methods while instrumentation is off
+    def instrument(self, obj, method_names):
+        for name in method_names:
+            setattr(obj, name, self.timed(name, getattr(obj, name)))
+
+    def add_counters(self, name, source):
+        self.counters[name] = source
+
+    def stats(self, **info):
+        stats = dict(self.session, time=time.time(), **info)
+        stats['timers'] = {name: timer.summary() for name, timer in self.timers.items() if timer.count}
+        stats['counters'] = {name: source() for name, source in self.counters.items()}
+        return stats
+
+    def dump(self, **info):
+        self.last_dump = time.monotonic()
+        if self.stats_path:
+            with open(self.stats_path, 'a') as f:
+                f.write(json.dumps(self.stats(**info)) + '\n')
+
+    # Dumps the stats if dump_interval has passed since the last dump; cheap enough to call every frame
+    def maybe_dump(self, **info):
+        if time.monotonic() - self.last_dump >= self.dump_interval:
+            self.dump(**info)
+
+    # Lines of text showing the recent percentiles of each operation, for the on-screen overlay
+    def overlay_lines(self):
+        lines = ['{:<28}{:>8}'.format('Timings (ms)', 'calls') + ''.join('{:>8}'.format('p%d' % p)
+                                                                         for p in STATS_PERCENTILES)]
+        for name, timer in self.timers.items():
+            if timer.count:
+                summary = timer.summary()
+                lines.append('{:<28}{:>8}'.format(name, timer.count) +
+                             ''.join('{:>8.1f}'.format(summary['p%d_ms' % p]) for p in STATS_PERCENTILES))
+        return lines
+
+
+# Context manager timing its block as the named operation, or doing nothing when instrumentation is off (None)
+def timing(instrumentation, name):
+    if instrumentation is None:
+        return nullcontext()
+    return instrumentation.timer(name)
+
+
+# Instrumentation as set up in configurations/configs.txt, or None unless it is switched on there with
+# 'INSTRUMENTATION:True'. 'STATS_PATH:' and 'STATS_INTERVAL:' set where and how often (in seconds) stats are dumped.
+def load_instrumentation():
+    enabled = False
+    stats_path = DEFAULT_STATS_PATH
+    interval = DUMP_INTERVAL
+    if os.path.exists(os.path.join('configurations', 'configs.txt')):
+        with open(os.path.join('configurations', 'configs.txt'), 'r') as c:
+            for line in c.readlines():
+                line = line.strip()
+                if line.startswith('INSTRUMENTATION:'):
+                    enabled = line[16:].strip().lower() == 'true'
+                if line.startswith('STATS_PATH:'):
+                    stats_path = line[11:].strip()
+                if line.startswith('STATS_INTERVAL:'):
+                    interval = float(line[15:])
+    if not enabled:
+        return None
+    return Instrumentation(stats_path, interval)
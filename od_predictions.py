@@ -0,0 +1,266 @@
+"""
+Object detection predictions (COCO results format) grouped by image, for quick lookup of an image's suggestions,
+and the box matching used to decide which predictions are suggested
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+from array import array
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+STORE_SUFFIX = '.index'
+STORE_ARRAYS = ('image_ids', 'offsets', 'bboxes', 'scores', 'category_ids')
+# Where stores are kept when they can't be written next to their json file, e.g. in a read-only directory
+STORE_CACHE_DIR = os.path.join('configurations', 'predictions')
+
+
+# All predictions of a detector, sorted by image_id so that each image's predictions are contiguous rows of the
+# bbox (x, y, width, height), score and category_id arrays; image_ids holds the sorted ids and offsets where each
+# image's rows start. Looking up an image costs only as much as its own predictions, however many predictions there
+# are in total. The arrays can be saved as a binary store and memory-mapped back, see open_prediction_store.
+class PredictionIndex:
+    def __init__(self, image_ids, offsets, bboxes, scores, category_ids):
+        self.image_ids = np.asarray(image_ids, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.category_ids = np.asarray(category_ids, dtype=np.int32)
+        # Directory the index was loaded from, or None if it is only held in memory
+        self.store_dir = None
+
+    def __len__(self):
+        return len(self.scores)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [0], np.zeros((0, 4)), [], [])
+
+    # Writes the index as a directory of .npy files, along with the (mtime, size) of the file it was built from and
+    # the score threshold predictions were filtered with
+    def save(self, store_dir, source_stamp, score_thresh=-np.inf):
+        tmp_dir = store_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in STORE_ARRAYS:
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(tmp_dir, 'source_stamp.npy'), np.asarray(source_stamp, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'score_thresh.npy'), np.asarray(score_thresh, dtype=np.float64))
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.rename(tmp_dir, store_dir)
+
+    # Opens a store written by save() with its arrays memory-mapped, so that only the pages of the images which are
+    # actually looked at are read into memory
+    @classmethod
+    def load(cls, store_dir):
+        index = cls(*[np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r') for name in STORE_ARRAYS])
+        index.store_dir = store_dir
+        return index
+
+    # Groups predictions given column-wise, in any order, by image_id. id_table holds the distinct image ids and
+    # image_codes the position in id_table of each prediction's image id.
+    @classmethod
+    def from_columns(cls, id_table, image_codes, bboxes, scores, category_ids):
+        if len(id_table) == 0:
+            return cls.empty()
+        ids = np.asarray(id_table, dtype=str)
+        id_order = np.argsort(ids, kind='stable')
+        rank = np.empty(len(ids), dtype=np.int64)
+        rank[id_order] = np.arange(len(ids))
+        image_rows = rank[np.asarray(image_codes, dtype=np.int64)]
+        order = np.argsort(image_rows, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(image_rows, minlength=len(ids)))])
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)[order]
+        return cls(ids[id_order], offsets, bboxes, np.asarray(scores, dtype=np.float64)[order],
+                   np.asarray(category_ids, dtype=np.int32)[order])
+
+    # Returns the (bboxes, scores, category_ids) arrays of an image's predictions, which are empty if it has none
+    def get(self, image_id):
+        row = int(np.searchsorted(self.image_ids, image_id))
+        if row == len(self.image_ids) or self.image_ids[row] != image_id:
+            return self.bboxes[:0], self.scores[:0], self.category_ids[:0]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.bboxes[start:end], self.scores[start:end], self.category_ids[start:end]
+
+
+# Converts COCO (x, y, width, height) boxes to integer (xmin, ymin, xmax, ymax) corners, truncating like int()
+def xywh_to_corners(bboxes):
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    return np.trunc(np.concatenate([bboxes[:, :2], bboxes[:, :2] + bboxes[:, 2:]], axis=1)).astype(np.int64)
+
+
+# Intersection-over-union of every box in boxes_a with every box in boxes_b, both given as N x 4 arrays of
+# (xmin, ymin, xmax, ymax). Returns a len(boxes_a) x len(boxes_b) array; boxes which don't overlap have an IoU of 0.
+def pairwise_iou(boxes_a, boxes_b):
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(1, -1, 4)
+    inter_w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = inter_w * inter_h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union != 0)
+
+
+# Mask of the predictions (COCO bboxes and scores of one image) to suggest: those scoring above score_thresh whose
+# IoU with each of the image's existing boxes (N x 4 corners) is below iou_thresh
+def select_suggestions(bboxes, scores, previous_boxes, score_thresh, iou_thresh):
+    keep = np.asarray(scores) > score_thresh
+    if len(previous_boxes) > 0 and keep.any():
+        max_iou = pairwise_iou(xywh_to_corners(bboxes), previous_boxes).max(axis=1)
+        keep &= max_iou < iou_thresh
+    return keep
+
+
+# Yields the records of a json file holding one top-level array (such as coco_instances_results.json) one at a
+# time, reading the file in chunks so that memory use doesn't depend on the size of the file
+def iter_json_array(json_file, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    def skip(chars):
+        nonlocal pos
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+
+    while True:
+        if not eof and len(buf) - pos < chunk_size:
+            data = json_file.read(chunk_size)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+        if not started:
+            skip(' \t\r\n')
+            if pos == len(buf):
+                if eof:
+                    raise ValueError('Expected a json array, but the file is empty')
+                continue
+            if buf[pos] != '[':
+                raise ValueError('Expected a json array at the top level')
+            pos += 1
+            started = True
+        skip(' \t\r\n,')
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Most likely a record cut off at the end of the current chunk; read more and try again
+            if eof:
+                raise
+            buf = buf[pos:] + json_file.read(chunk_size)
+            pos = 0
+            continue
+        pos = end
+        yield record
+
+
+# Largest resident set size of this process so far in bytes, or None where this can't be measured
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# Streams the predictions of a coco_instances_results.json file straight into a PredictionIndex, dropping those
+# scoring at or below score_thresh as they are read, so neither the json nor the dropped predictions are ever held
+# in memory. Prints throughput and peak memory once done.
+def read_predictions(json_path, score_thresh=None):
+    start = time.perf_counter()
+    id_codes = {}
+    image_codes = array('q')
+    bboxes = array('d')
+    scores = array('d')
+    category_ids = array('i')
+    total = 0
+    with open(json_path) as json_file:
+        for record in iter_json_array(json_file):
+            total += 1
+            if score_thresh is not None and not record['score'] > score_thresh:
+                continue
+            image_id = str(record['image_id'])
+            code = id_codes.get(image_id)
+            if code is None:
+                code = id_codes[image_id] = len(id_codes)
+            image_codes.append(code)
+            bboxes.extend(record['bbox'])
+            scores.append(record['score'])
+            category_ids.append(record['category_id'])
+    index = PredictionIndex.from_columns(list(id_codes), image_codes, bboxes, scores, category_ids)
+    elapsed = time.perf_counter() - start
+    size_mb = os.path.getsize(json_path) / 1024 ** 2
+    rss = peak_rss()
+    print('Read {} predictions ({} kept) from {:.1f} MB in {:.1f}s: {:.1f} MB/s, {:.0f} predictions/s{}'.format(
+        total, len(index), size_mb, elapsed, size_mb / max(elapsed, 1e-9), total / max(elapsed, 1e-9),
+        ', peak memory {:.0f} MB'.format(rss / 1024 ** 2) if rss is not None else ''))
+    return index
+
+
+def source_stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+# Directories the store of a json file can be kept in, in order of preference: next to the json file (json_path +
+# '.index'), or else in STORE_CACHE_DIR under a name made from a hash of the json's absolute path
+def prediction_store_dirs(json_path):
+    key = hashlib.sha1(os.path.abspath(json_path).encode('utf-8')).hexdigest()[:16]
+    return [json_path + STORE_SUFFIX,
+            os.path.join(STORE_CACHE_DIR, '{}.{}{}'.format(os.path.basename(json_path), key, STORE_SUFFIX))]
+
+
+# Returns the predictions of a coco_instances_results.json file as a memory-mapped PredictionIndex. The index is
+# kept in a binary store (see prediction_store_dirs), which is (re)built from the json whenever it is missing, the
+# json's mtime or size has changed since it was built, or it was built with a higher score_thresh than the one asked
+# for (predictions at or below score_thresh are left out of the store). If the store can't be saved anywhere, the
+# index is returned as built, in memory.
+def open_prediction_store(json_path, score_thresh=None):
+    store_dirs = prediction_store_dirs(json_path)
+    stamp = source_stamp(json_path)
+    thresh = -np.inf if score_thresh is None else score_thresh
+    for store_dir in store_dirs:
+        try:
+            saved_stamp = np.load(os.path.join(store_dir, 'source_stamp.npy'))
+            saved_thresh = np.load(os.path.join(store_dir, 'score_thresh.npy'))
+            if tuple(saved_stamp.tolist()) == stamp and float(saved_thresh) <= thresh:
+                return PredictionIndex.load(store_dir)
+        except (OSError, ValueError):
+            pass
+    print('Building prediction store for {}...'.format(json_path))
+    index = read_predictions(json_path, score_thresh)
+    for store_dir in store_dirs:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(store_dir)), exist_ok=True)
+            index.save(store_dir, stamp, thresh)
+            return PredictionIndex.load(store_dir)
+        except OSError as e:
+            print('WARNING: Could not save prediction store to {}: {}'.format(store_dir, e))
+    print('WARNING: Keeping the predictions of {} in memory only; they will be read again next time'.format(json_path))
+    return index
+
+
+# One-off conversion of prediction files, e.g. to build their stores ahead of annotating. Give the same threshold
+# as PREDICTION_THRESH to leave out predictions the annotator would never suggest:
+#     python od_predictions.py [--thresh PREDICTION_THRESH] path/to/coco_instances_results.json [...]
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    thresh = None
+    if args[:1] == ['--thresh']:
+        thresh = float(args[1])
+        args = args[2:]
+    for json_path in args:
+        predictions = open_prediction_store(json_path, thresh)
+        print('{}: {} predictions for {} images'.format(json_path, len(predictions), len(predictions.image_ids)))
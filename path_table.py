@@ -0,0 +1,166 @@
+"""
+Compact, array-backed table of the relative image paths of a library, and the naming of the files which belong to an
+image (annotations, metadata) after its path
+"""
+
+import os
+import numpy as np
+
+PATH_TABLE_VERSION = 1
+
+
+# Path of image_path without the extension of its file name, i.e. up to the first '.' of the file name; annotation
+# and metadata files are named after it. Dots in directory names are kept.
+def path_stem(image_path):
+    rel_dir, name = os.path.split(str(image_path))
+    dot = name.find('.')
+    return os.path.join(rel_dir, name[:dot]) if dot >= 0 else str(image_path)
+
+
+# Packs strings into one UTF-8 buffer (as a uint8 array) and the offsets of each string's bytes in it
+def pack_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(buffer, offsets):
+    data = np.asarray(buffer, dtype=np.uint8).tobytes()
+    offsets = np.asarray(offsets).tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+# Relative image paths in a fixed order, stored as a table of the distinct directories plus, per path, the id of its
+# directory and its file name's bytes within one shared buffer: a few bytes per path on top of the name itself,
+# rather than a Python string per path. Path i is dirs[dir_ids[i]] joined with the file name
+# names[name_offsets[i]:name_offsets[i + 1]], whose first stem_lengths[i] bytes are its stem (see path_stem).
+# Behaves as a read-only sequence of path strings, which are only made when asked for. find() searches an index of
+# the rows sorted by (directory, name), made on its first call.
+class PathTable:
+    def __init__(self, dirs, dir_ids, names, name_offsets, stem_lengths):
+        self.dirs = list(dirs)
+        self.dir_index = {d: i for i, d in enumerate(self.dirs)}
+        self.dir_ids = np.asarray(dir_ids, dtype=np.int32)
+        self.names = bytes(np.asarray(names, dtype=np.uint8)) if not isinstance(names, bytes) else names
+        self.name_offsets = np.asarray(name_offsets, dtype=np.int64)
+        self.stem_lengths = np.asarray(stem_lengths, dtype=np.int32)
+        self.sorted_rows = None
+
+    @classmethod
+    def from_paths(cls, paths):
+        dir_index = {}
+        dir_ids = []
+        names = []
+        stem_lengths = []
+        for path in paths:
+            rel_dir, name = os.path.split(str(path))
+            dir_ids.append(dir_index.setdefault(rel_dir, len(dir_index)))
+            encoded = name.encode('utf-8')
+            names.append(encoded)
+            dot = name.find('.')
+            stem_lengths.append(len(name[:dot].encode('utf-8')) if dot >= 0 else len(encoded))
+        name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in names], out=name_offsets[1:])
+        return cls(list(dir_index), dir_ids, b''.join(names), name_offsets, stem_lengths)
+
+    def __len__(self):
+        return len(self.dir_ids)
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        if ind < 0:
+            ind += len(self)
+        return os.path.join(self.dirs[self.dir_ids[ind]], self.name(ind))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, path):
+        return self.find(path) >= 0
+
+    def name(self, ind):
+        return self.name_bytes(ind).decode('utf-8')
+
+    def name_bytes(self, ind):
+        return self.names[self.name_offsets[ind]:self.name_offsets[ind + 1]]
+
+    def stem(self, ind):
+        start = self.name_offsets[ind]
+        return os.path.join(self.dirs[self.dir_ids[ind]],
+                            self.names[start:start + self.stem_lengths[ind]].decode('utf-8'))
+
+    # Relative path of the file named after image ind with the given suffix, e.g. its annotation file
+    def annotation_path(self, ind, file_extension):
+        return self.stem(ind) + file_extension
+
+    # Rows sorted by directory id and then file name bytes. The names are laid out as one fixed-width bytes array
+    # just for the sort, which orders them as Python compares bytes (they never contain null bytes, which fixed-width
+    # bytes are padded with).
+    def sort_rows(self):
+        lengths = np.diff(self.name_offsets)
+        width = max(int(lengths.max()) if len(lengths) else 0, 1)
+        padded = np.zeros((len(self), width), dtype=np.uint8)
+        rows = np.repeat(np.arange(len(self)), lengths)
+        padded[rows, np.arange(len(rows)) - np.repeat(self.name_offsets[:-1], lengths)] = \
+            np.frombuffer(self.names, dtype=np.uint8)
+        return np.lexsort((padded.view('S{}'.format(width)).ravel(), self.dir_ids)).astype(np.int32)
+
+    # Index of path in the table, or -1 if it isn't in it; a binary search over sorted_rows
+    def find(self, path):
+        rel_dir, name = os.path.split(str(path))
+        dir_id = self.dir_index.get(rel_dir)
+        if dir_id is None:
+            return -1
+        if self.sorted_rows is None:
+            self.sorted_rows = self.sort_rows()
+        key = (dir_id, name.encode('utf-8'))
+        lo, hi = 0, len(self.sorted_rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = int(self.sorted_rows[mid])
+            if (int(self.dir_ids[row]), self.name_bytes(row)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.sorted_rows):
+            row = int(self.sorted_rows[lo])
+            if int(self.dir_ids[row]) == dir_id and self.name_bytes(row) == key[1]:
+                return row
+        return -1
+
+    def index(self, path):
+        ind = self.find(path)
+        if ind < 0:
+            raise ValueError('{} is not in the path table'.format(path))
+        return ind
+
+    # Memory taken by the table's arrays, in bytes
+    def nbytes(self):
+        return len(self.names) + self.name_offsets.nbytes + self.dir_ids.nbytes + self.stem_lengths.nbytes + \
+            sum(len(d) for d in self.dirs)
+
+    # The table as a dictionary of arrays (with the given prefix on their names), for saving with np.savez
+    def to_arrays(self, prefix=''):
+        dir_buffer, dir_offsets = pack_strings(self.dirs)
+        return {prefix + 'version': np.asarray(PATH_TABLE_VERSION), prefix + 'dirs': dir_buffer,
+                prefix + 'dir_offsets': dir_offsets, prefix + 'dir_ids': self.dir_ids,
+                prefix + 'names': np.frombuffer(self.names, dtype=np.uint8), prefix + 'name_offsets': self.name_offsets,
+                prefix + 'stem_lengths': self.stem_lengths}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        if int(arrays[prefix + 'version']) != PATH_TABLE_VERSION:
+            raise ValueError('Unsupported path table version')
+        return cls(unpack_strings(arrays[prefix + 'dirs'], arrays[prefix + 'dir_offsets']), arrays[prefix + 'dir_ids'],
+                   arrays[prefix + 'names'], arrays[prefix + 'name_offsets'], arrays[prefix + 'stem_lengths'])
+
+    def save(self, file):
+        np.savez(file, **self.to_arrays())
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file, allow_pickle=False) as arrays:
+            return cls.from_arrays(arrays)
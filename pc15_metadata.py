@@ -0,0 +1,287 @@
+"""
+Cached access to the per-image metadata .xml files of the PlantCLEF 2015 dataset format
+"""
+
+import os
+import heapq
+from array import array
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from path_table import PathTable, path_stem, pack_strings, unpack_strings
+
+NO_XML = -2
+NOT_FOUND = -1
+NO_XML_MSG = '**no metadata xml file found**'
+SORT_CACHE_VERSION = 4
+# (mtime, size) saved for images without a metadata xml
+NO_STAT = -1
+# Below this many files to (re-)read, starting worker processes costs more than it saves
+PROCESS_POOL_MIN_FILES = 500
+
+
+def metadata_xml_path(lib_path, image_path):
+    return os.path.join(lib_path, path_stem(image_path) + '.xml')
+
+
+# Reads the species and content (metadata category) of an image from its PlantCLEF metadata xml. Either field is
+# None if not present in the file, and None is returned if there is no metadata file for the image at all.
+def read_PC15_metadata(lib_path, image_path):
+    xml = metadata_xml_path(lib_path, image_path)
+    if not os.path.exists(xml):
+        return None
+    species = None
+    content = None
+    with open(xml, 'r', encoding='utf-8') as x:
+        for line in x:
+            line = line.strip()
+            if species is None and line.startswith('<Species>'):
+                species = line[9:-10]
+            elif content is None and line.startswith('<Content>'):
+                content = line[9:-10]
+            if species is not None and content is not None:
+                break
+    return species, content
+
+
+# Returns (mtime, size) of an image's metadata xml, or None if it has none
+def stat_PC15_metadata(lib_path, image_path):
+    try:
+        st = os.stat(metadata_xml_path(lib_path, image_path))
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+# Species followed by metadata category, which is what the dataset is sorted by; missing values sort as empty strings
+def PC15_sort_key(metadata):
+    if metadata is None:
+        return ''
+    return (metadata[0] or '') + (metadata[1] or '')
+
+
+# Saves the sort cache as a NumPy .npz file of plain arrays: the sorted paths as a PathTable, the (mtime, size) of
+# each one's metadata xml (NO_STAT if it has none), its species and content as ids into one string table (NO_XML and
+# NOT_FOUND as in PC15MetadataStore), and the directory mtimes. Written through a temporary file, so an interrupted
+# save leaves the previous cache in place.
+def save_sort_cache(cache_file, sorted_paths, entries, dir_mtimes):
+    strings = {}
+    stats = np.full((len(sorted_paths), 2), NO_STAT, dtype=np.int64)
+    ids = np.full((len(sorted_paths), 2), NO_XML, dtype=np.int32)
+    for i, p in enumerate(sorted_paths):
+        st, metadata = entries[p]
+        if st is not None:
+            stats[i] = st
+        if metadata is not None:
+            ids[i] = [NOT_FOUND if m is None else strings.setdefault(m, len(strings)) for m in metadata]
+    string_buffer, string_offsets = pack_strings(strings)
+    dirs = sorted(dir_mtimes)
+    dir_buffer, dir_offsets = pack_strings(dirs)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, version=np.asarray(SORT_CACHE_VERSION), stats=stats, ids=ids, strings=string_buffer,
+                 string_offsets=string_offsets, dirs=dir_buffer, dir_offsets=dir_offsets,
+                 dir_mtimes=np.asarray([dir_mtimes[d] for d in dirs], dtype=np.int64),
+                 **PathTable.from_paths(sorted_paths).to_arrays('order_'))
+    os.replace(tmp_file, cache_file)
+
+
+# Loads a cache saved by save_sort_cache as (PathTable of the sorted paths, N x 2 array of (mtime, size), per-path
+# metadata, dir_mtimes), or None if there is no usable cache. Metadata is returned as (species, content) tuples,
+# or None for images without a metadata xml.
+def load_sort_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file, allow_pickle=False) as saved:
+            if int(saved['version']) != SORT_CACHE_VERSION:
+                return None
+            order = PathTable.from_arrays(saved, 'order_')
+            stats = saved['stats']
+            ids = saved['ids'].tolist()
+            strings = unpack_strings(saved['strings'], saved['string_offsets'])
+            dir_mtimes = dict(zip(unpack_strings(saved['dirs'], saved['dir_offsets']), saved['dir_mtimes'].tolist()))
+    except (OSError, ValueError, KeyError):
+        return None
+    metadata = [None if species_id == NO_XML else (None if species_id == NOT_FOUND else strings[species_id],
+                                                    None if content_id == NOT_FOUND else strings[content_id])
+                for species_id, content_id in ids]
+    return order, stats, metadata, dir_mtimes
+
+
+# Sorts image_paths into species and then metadata category, returning them as a PathTable. The sorted order, along
+# with the (mtime, size) and metadata of every metadata xml, is kept in cache_file (see save_sort_cache), so that
+# later calls only re-read files that are new or whose mtime or size changed (spreading the reads over a process pool
+# when there are many of them) and merge them into the existing order. rebuild=True ignores the cache. All metadata
+# is also added to store, if given.
+# Given dir_mtimes, the mtime of each directory (as returned by scan_library), the mtimes are kept in the cache too,
+# and metadata files are only checked for changes in directories whose mtime differs from the cached one; files in
+# the other directories have been neither added, removed nor replaced since, so their cached entries are used as is.
+# When no directory changed at all, the cached order is returned without building any per-path state.
+# Editing a metadata file in place changes its own mtime but not its directory's, so such edits are only picked up
+# with check_all=True, which stats every metadata file (still only re-reading the ones which changed).
+def sort_paths_by_species(lib_path, image_paths, cache_file, store=None, rebuild=False, workers=None,
+                          dir_mtimes=None, check_all=False):
+    saved = None if rebuild else load_sort_cache(cache_file)
+    if saved is not None and dir_mtimes is not None and not check_all and dir_mtimes == saved[3] and \
+            len(image_paths) == len(saved[0]):
+        order, _, metadata, _ = saved
+        if store is not None:
+            store.add_table(order, metadata)
+        return order
+
+    entries = {}
+    order = []
+    saved_dir_mtimes = {}
+    if saved is not None:
+        order = list(saved[0])
+        saved_stats = [None if st[0] == NO_STAT else tuple(st) for st in saved[1].tolist()]
+        entries = dict(zip(order, zip(saved_stats, saved[2])))
+        saved_dir_mtimes = saved[3]
+
+    if dir_mtimes is None:
+        dir_mtimes = {}
+        to_stat = image_paths
+    elif check_all:
+        to_stat = image_paths
+    else:
+        changed_dirs = set(d for d, mtime in dir_mtimes.items() if saved_dir_mtimes.get(d) != mtime)
+        to_stat = [p for p in image_paths if p not in entries or os.path.dirname(p) in changed_dirs]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        stats = dict(zip(to_stat, pool.map(partial(stat_PC15_metadata, lib_path), to_stat)))
+    current = {}
+    changed = []
+    for p in image_paths:
+        entry = entries.get(p)
+        st = stats[p] if p in stats else entry[0]
+        if entry is not None and entry[0] == st:
+            current[p] = entry
+        else:
+            changed.append((p, st))
+
+    if changed:
+        print('Reading metadata for {} new or modified files...'.format(len(changed)))
+        changed_paths = [p for p, _ in changed]
+        read = partial(read_PC15_metadata, lib_path)
+        if len(changed) >= PROCESS_POOL_MIN_FILES:
+            from concurrent.futures import ProcessPoolExecutor  # Loads multiprocessing, so only when needed
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                metadata = list(pool.map(read, changed_paths, chunksize=256))
+        else:
+            metadata = [read(p) for p in changed_paths]
+        for (p, st), m in zip(changed, metadata):
+            current[p] = (st, m)
+
+    def key(p):
+        return PC15_sort_key(current[p][1]), p
+
+    changed_set = set(p for p, _ in changed)
+    kept = [p for p in order if p in current and p not in changed_set]
+    sorted_paths = list(heapq.merge(kept, sorted(changed_set, key=key), key=key))
+    if changed or len(kept) != len(order) or dir_mtimes != saved_dir_mtimes:
+        save_sort_cache(cache_file, sorted_paths, current, dir_mtimes)
+
+    table = PathTable.from_paths(sorted_paths)
+    if store is not None:
+        store.add_table(table, [current[p][1] for p in sorted_paths])
+    return table
+
+
+# Species and content of every image seen so far, keyed by image path. Each image's metadata file is read at most
+# once; the strings themselves are interned in a shared table, so that the whole library can be held in memory as
+# two integer ids per image. The metadata of a whole PathTable is added with add_table, whose rows are then found
+# through the table rather than a dictionary of path strings.
+class PC15MetadataStore:
+    def __init__(self, lib_path):
+        self.lib_path = lib_path
+        self.rows = {}
+        self.table = None
+        self.table_start = 0
+        self.species_ids = array('i')
+        self.content_ids = array('i')
+        self.strings = []
+        self.string_ids = {}
+
+    def __len__(self):
+        return len(self.rows) + (len(self.table) if self.table is not None else 0)
+
+    def intern(self, s):
+        if s is None:
+            return NOT_FOUND
+        ind = self.string_ids.get(s)
+        if ind is None:
+            ind = len(self.strings)
+            self.strings.append(s)
+            self.string_ids[s] = ind
+        return ind
+
+    def ids(self, metadata):
+        if metadata is None:
+            return NO_XML, NO_XML
+        return self.intern(metadata[0]), self.intern(metadata[1])
+
+    def add(self, image_path, metadata):
+        species_id, content_id = self.ids(metadata)
+        row = self.find_row(image_path)
+        if row is None:
+            self.rows[image_path] = len(self.species_ids)
+            self.species_ids.append(species_id)
+            self.content_ids.append(content_id)
+        else:
+            self.species_ids[row] = species_id
+            self.content_ids[row] = content_id
+
+    # Adds the metadata of every path in a PathTable, metadata being a list in the same order
+    def add_table(self, table, metadata):
+        self.table = table
+        self.table_start = len(self.species_ids)
+        for m in metadata:
+            species_id, content_id = self.ids(m)
+            self.species_ids.append(species_id)
+            self.content_ids.append(content_id)
+
+    # Reads the metadata for every image in image_paths not already in the store, using a pool of worker threads
+    # since reading many small files is dominated by I/O latency
+    def preload(self, image_paths, workers=8):
+        missing = [p for p in image_paths if self.find_row(p) is None]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for p, metadata in zip(missing, pool.map(lambda x: read_PC15_metadata(self.lib_path, x), missing)):
+                self.add(p, metadata)
+
+    # Row of image_path in the id arrays, or None if it isn't in the store
+    def find_row(self, image_path):
+        row = self.rows.get(image_path)
+        if row is None and self.table is not None:
+            ind = self.table.find(image_path)
+            if ind >= 0:
+                row = self.table_start + ind
+        return row
+
+    # Species ids of every path in a PathTable, in its order; metadata not in the store yet is read first
+    def table_species_ids(self, table):
+        if table is self.table:
+            return np.array(self.species_ids[self.table_start:self.table_start + len(table)], dtype=np.int32)
+        self.preload(table)
+        return np.asarray([self.species_ids[self.row(p)] for p in table], dtype=np.int32)
+
+    def row(self, image_path):
+        row = self.find_row(image_path)
+        if row is None:
+            self.add(image_path, read_PC15_metadata(self.lib_path, image_path))
+            row = self.rows[image_path]
+        return row
+
+    def lookup(self, string_id, not_found_msg):
+        if string_id == NO_XML:
+            return NO_XML_MSG
+        if string_id == NOT_FOUND:
+            return not_found_msg
+        return self.strings[string_id]
+
+    def species(self, image_path):
+        return self.lookup(self.species_ids[self.row(image_path)], '**no image species found**')
+
+    def content(self, image_path):
+        return self.lookup(self.content_ids[self.row(image_path)], '**no image label found**')
+
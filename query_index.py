@@ -0,0 +1,203 @@
+"""
+Queries over the annotations and metadata of a whole library, e.g. all images with a box of a given class, so that
+navigation can jump straight between the images matching a filter
+"""
+
+import re
+import numpy as np
+from voc_dataset import load_voc_dataset
+from voc_save_load import NO_RANK
+
+# Terms of a query string, e.g. 'class=flower boxes>3 size<20 species=Acer campestre L. rank=1'. Every term must
+# hold for an image to match; a term's value runs up to the next term, so species names can contain spaces.
+QUERY_TERM_RE = re.compile(r'(class|species)\s*=\s*|(boxes)\s*>\s*|(size)\s*<\s*|(rank)\s*=\s*')
+
+
+# A filter on images, each condition being None when not in use:
+# class_name     the image has a box of this class
+# min_boxes      the image has more than this many boxes
+# max_box_side   the image has a box less than this many pixels wide or high
+# species        the image's PlantCLEF species is this one
+# rank           the image has a box with this observation rank
+class ImageQuery:
+    FIELDS = ('class_name', 'min_boxes', 'max_box_side', 'species', 'rank')
+
+    def __init__(self, class_name=None, min_boxes=None, max_box_side=None, species=None, rank=None):
+        self.class_name = class_name
+        self.min_boxes = min_boxes
+        self.max_box_side = max_box_side
+        self.species = species
+        self.rank = rank
+
+    def __eq__(self, other):
+        return isinstance(other, ImageQuery) and self.values() == other.values()
+
+    def values(self):
+        return tuple(getattr(self, f) for f in self.FIELDS)
+
+    def is_empty(self):
+        return all(v is None for v in self.values())
+
+    # Copy of the query with some of its conditions changed
+    def replace(self, **changes):
+        values = dict(zip(self.FIELDS, self.values()))
+        values.update(changes)
+        return ImageQuery(**values)
+
+    def __str__(self):
+        terms = []
+        if self.class_name is not None:
+            terms.append('class={}'.format(self.class_name))
+        if self.min_boxes is not None:
+            terms.append('boxes>{}'.format(self.min_boxes))
+        if self.max_box_side is not None:
+            terms.append('size<{}'.format(self.max_box_side))
+        if self.species is not None:
+            terms.append('species={}'.format(self.species))
+        if self.rank is not None:
+            terms.append('rank={}'.format(self.rank))
+        return ' '.join(terms)
+
+
+# Reads a query string as written by ImageQuery.__str__; raises ValueError for anything else
+def parse_query(text):
+    text = text.strip()
+    terms = list(QUERY_TERM_RE.finditer(text))
+    if text and (not terms or terms[0].start() != 0):
+        raise ValueError('Could not read query "{}"'.format(text))
+    values = {}
+    for term, next_term in zip(terms, terms[1:] + [None]):
+        value = text[term.end():next_term.start() if next_term is not None else len(text)].strip()
+        name = term.group(term.lastindex)
+        if not value:
+            raise ValueError('Missing value for "{}" in query "{}"'.format(name, text))
+        if name == 'class':
+            values['class_name'] = value
+        elif name == 'species':
+            values['species'] = value
+        elif name == 'boxes':
+            values['min_boxes'] = int(value)
+        elif name == 'size':
+            values['max_box_side'] = int(value)
+        else:
+            values['rank'] = int(value)
+    return ImageQuery(**values)
+
+
+# For images[i] the image box i belongs to, the images (out of n) which meet the box conditions of query, as a mask.
+# is_class marks the boxes of query.class_name, if set.
+def box_conditions(query, n, images, is_class, widths, heights, ranks):
+    mask = np.ones(n, dtype=bool)
+    if query.class_name is not None:
+        mask &= np.bincount(images[is_class], minlength=n) > 0
+    if query.min_boxes is not None:
+        mask &= np.bincount(images, minlength=n) > query.min_boxes
+    if query.max_box_side is not None:
+        small = (widths < query.max_box_side) | (heights < query.max_box_side)
+        mask &= np.bincount(images[small], minlength=n) > 0
+    if query.rank is not None:
+        mask &= np.bincount(images[ranks == query.rank], minlength=n) > 0
+    return mask
+
+
+# The labels, boxes and observation ranks of every annotated image of a library, read once (through a VOCDataset,
+# cached in cache_file) and then queried in memory. Images are indices into paths, the app's PathTable; annotations
+# the app saves later are passed to update(), which overrides what was read from disk for that image.
+#
+# match() returns the sorted indices of the images matching a query, which next_match/prev_match bisect to move
+# from one image to the next matching one.
+class QueryIndex:
+    def __init__(self, paths, dataset, file_extension, annotated, metadata=None):
+        self.paths = paths
+        self.dataset = dataset
+        self.metadata = metadata
+        self.species_ids = None
+        # Only images with an annotation file can appear in the dataset, so only their names need looking up
+        names = {paths.annotation_path(i, file_extension): i for i in np.flatnonzero(annotated).tolist()}
+        image_of_file = np.asarray([names.get(f, -1) for f in dataset.files.tolist()], dtype=np.int64)
+        self.box_images = image_of_file[dataset.image_index] if len(dataset) else np.zeros(0, dtype=np.int64)
+        self.edited = {}
+        self.query = None
+        self.matches = np.zeros(0, dtype=np.int64)
+
+    # Builds the index for an app, reading every annotation file ending in file_extension under lib_path (or just
+    # the new and changed ones, given a cache_file from an earlier build)
+    @classmethod
+    def build(cls, lib_path, paths, file_extension, annotated, metadata=None, cache_file=None):
+        return cls(paths, load_voc_dataset(lib_path, file_extension, cache_file), file_extension, annotated, metadata)
+
+    # Per-box columns (image, whether of query.class_name, width, height, rank) of every image, with the boxes of
+    # edited images taken from their edits
+    def box_columns(self, query):
+        d = self.dataset
+        keep = self.box_images >= 0
+        if self.edited:
+            keep &= ~np.isin(self.box_images, list(self.edited))
+        class_ids = np.flatnonzero(d.classes == query.class_name)
+        is_class = d.class_id == class_ids[0] if len(class_ids) else np.zeros(len(d), dtype=bool)
+        columns = [self.box_images[keep], is_class[keep], d.box_widths()[keep], d.box_heights()[keep],
+                   d.observation_rank[keep]]
+        for ind, (boxes, labels, ranks) in self.edited.items():
+            edited = [np.full(len(labels), ind, dtype=np.int64), np.asarray([l == query.class_name for l in labels],
+                                                                            dtype=bool),
+                      boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1], ranks]
+            columns = [np.concatenate([c, e]) for c, e in zip(columns, edited)]
+        return columns
+
+    def species_mask(self, species):
+        if self.metadata is None:
+            print('WARNING: No PlantCLEF metadata available; the species filter matches nothing')
+            return np.zeros(len(self.paths), dtype=bool)
+        if self.species_ids is None:
+            self.species_ids = self.metadata.table_species_ids(self.paths)
+        species_id = self.metadata.string_ids.get(species)
+        if species_id is None:
+            return np.zeros(len(self.paths), dtype=bool)
+        return self.species_ids == species_id
+
+    # Sorted indices of the images matching query, which also becomes the query kept up to date by update()
+    def match(self, query):
+        images, is_class, widths, heights, ranks = self.box_columns(query)
+        mask = box_conditions(query, len(self.paths), images, is_class, widths, heights, ranks)
+        if query.species is not None:
+            mask &= self.species_mask(query.species)
+        self.query = query
+        self.matches = np.flatnonzero(mask)
+        return self.matches
+
+    # Records the annotations now saved for image ind (boxes as an N x 4 (xmin, ymin, xmax, ymax) array and a label
+    # per box, all with observation rank rank), and adds it to or removes it from the current matches
+    def update(self, ind, boxes, labels, rank=NO_RANK):
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.edited[ind] = (boxes, list(labels), np.full(len(boxes), rank, dtype=np.int64))
+        if self.query is None:
+            return
+        query = self.query
+        matched = box_conditions(query, 1, np.zeros(len(boxes), dtype=np.int64),
+                                 np.asarray([l == query.class_name for l in labels], dtype=bool),
+                                 boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1], self.edited[ind][2])[0]
+        if matched and query.species is not None:
+            matched = bool(self.species_mask(query.species)[ind])
+        pos = int(np.searchsorted(self.matches, ind))
+        present = pos < len(self.matches) and self.matches[pos] == ind
+        if matched and not present:
+            self.matches = np.insert(self.matches, pos, ind)
+        elif present and not matched:
+            self.matches = np.delete(self.matches, pos)
+
+    # First matching image after ind, wrapping around past the last image; -1 if nothing matches. Given a candidate
+    # mask over all images (e.g. whether each image is annotated), only matches which are also candidates count.
+    def next_match(self, ind, candidates=None):
+        matches = self.matches if candidates is None else self.matches[candidates[self.matches]]
+        if len(matches) == 0:
+            return -1
+        pos = int(np.searchsorted(matches, ind, side='right'))
+        return int(matches[pos % len(matches)])
+
+    # Last matching image before ind, wrapping around past the first image; -1 if nothing matches
+    def prev_match(self, ind, candidates=None):
+        matches = self.matches if candidates is None else self.matches[candidates[self.matches]]
+        if len(matches) == 0:
+            return -1
+        pos = int(np.searchsorted(matches, ind, side='left'))
+        return int(matches[pos - 1])
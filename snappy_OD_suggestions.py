@@ -3,20 +3,67 @@ Annotation tool specifically designed for snappy annotation on object detection
 """
 
 import anntoolkit
-import imageio
 import os
-import copy
-import pickle
+import argparse
 import numpy as np
-import cv2
-from voc_save_load import save_to_voc_xml, load_from_voc_xml
-
-import json
+from functools import partial
+from voc_save_load import voc_xml_string, load_annotation_store
+from image_cache import ImageCache, decode_region
+from annotation_index import AnnotationIndex, scan_library
+from pc15_metadata import PC15MetadataStore, sort_paths_by_species, NO_XML_MSG
+from path_table import PathTable
+from annotation_writer import AnnotationWriter
+from box_index import BoxIndex
+from annotation_store import AnnotationStore, LabelTable
+from draw_list import DrawList
+from display_view import DisplayView, detail_region
+from thumbnails import ThumbnailCache, ThumbnailPage, GRID_PAGE_SIZE, THUMBNAIL_SIDE
+from instrumentation import load_instrumentation, timing
+from query_index import ImageQuery, QueryIndex, parse_query
+from od_predictions import PredictionIndex, open_prediction_store, select_suggestions, xywh_to_corners
 
 LIB_PATH_ERROR = 'Error: Directory specified not found. Please ensure \'LIBRARY_PATH:\' line in ' \
                  '\'configurations/configs.txt\' is followed by a legitimate directory.'
+# Number of images on either side of the current one which are decoded in the background while annotating
+PREFETCH_RANGE = 3
+# Memory budget for decoded images kept around for quick navigation
+IMAGE_CACHE_BYTES = 1024 ** 3
 PREV_ANNOT_EXT = '_annotations.xml'
 FILE_EXT = '_od_annotations.xml'
+# Directory listings of the library from the last launch, so that only changed directories are listed again
+MANIFEST_FILE = 'library_manifest_od.pkl'
+# Labels, boxes and ranks of every annotation file as read for the last query, so that only changed files are read
+# again
+QUERY_CACHE_FILE = 'annotation_dataset_od.npz'
+# Methods timed when instrumentation is switched on (see instrumentation.load_instrumentation)
+INSTRUMENTED_METHODS = (
+    'load_next',
+    'load_prev',
+    'load_image_at',
+    'load_next_not_annotated',
+    'load_next_annotated',
+    'load_prev_not_annotated',
+    'load_prev_annotated',
+    'load_current_im_info',
+    'show_current_image',
+    'get_image_dims',
+    'get_PC15_species',
+    'get_PC15_metadata_category',
+    'save_progress',
+    'show_grid_page',
+    'load_json_annotations',
+    'apply_query',
+    'build_draw_list',
+    'on_update',
+)
+# Outline and fill colors of the boxes of the first classes in classes.txt, in order. Colors are implemented for the
+# first 5 labels; more can be added if desired. Boxes of any other label use OTHER_CLASS_COLORS.
+CLASS_COLORS = [((0, 255, 0, 0), (0, 255, 0, 120)),
+                 ((255, 0, 0, 0), (255, 0, 0, 120)),
+                 ((249, 21, 218, 0), (249, 21, 218, 120)),
+                 ((127, 127, 127, 0), (1, 50, 32, 120)),
+                 ((1, 50, 32, 120), (1, 50, 32, 180))]
+OTHER_CLASS_COLORS = ((0, 255, 0, 250), (100, 255, 100, 120))
 
 
 def load_configs():
@@ -25,6 +72,7 @@ def load_configs():
     default_lbl = '1'
     sort_species = True
     database_chgd = False
+    metadata_restat = False
     prediction_pth = ''
     prediction_thrsh = 0.5
     iou_thrsh = 0.75
@@ -44,6 +92,8 @@ def load_configs():
                     sort_species = line[16:].lower() == 'true'
                 if line.startswith('DB_CHANGED:'):
                     database_chgd = line[11:] == 'True'
+                if line.startswith('METADATA_RESTAT:'):
+                    metadata_restat = line[16:] == 'True'
                 if line.startswith('PREDICTIONS_PATH:'):
                     prediction_pth = line[17:]
                 if line.startswith('PREDICTION_THRESH:'):
@@ -52,13 +102,14 @@ def load_configs():
                     obs_rank = int(line[20:])
                     obs_rank_found = True
                 if line.startswith('IOU_THRESH:'):
-                    iou_thrsh = float(line[11])
+                    iou_thrsh = float(line[11:])
         if not obs_rank_found:
             # Make this an error message that quits in the future
             print('WARNING: Observation rank (used to refer to whether OD is used for suggestions) is '
                   'currently un-set. Please update config file with line \'OD_OBSERVATION_RANK:\', followed '
                   'by corresponding number')
-    return lib_path, db, default_lbl, sort_species, database_chgd, prediction_pth, prediction_thrsh, obs_rank, iou_thrsh
+    return lib_path, db, default_lbl, sort_species, database_chgd, metadata_restat, prediction_pth, prediction_thrsh, \
+        obs_rank, iou_thrsh
 
 
 def load_classes():
@@ -70,265 +121,258 @@ def load_classes():
     return class_keys
 
 
-def reset_box(bbox):
-    xmin = min(bbox[0][0], bbox[1][0])
-    xmax = max(bbox[0][0], bbox[1][0])
-    ymin = min(bbox[0][1], bbox[1][1])
-    ymax = max(bbox[0][1], bbox[1][1])
-    return [(xmin, ymin), (xmax, ymax)]
-
-
 class App(anntoolkit.App):
-    def __init__(self):
+    def __init__(self, query=None):
         super(App, self).__init__(title='Snappy Annotator - OD-Assisted Annotation')
 
         self.POINT_RADIUS = 6
-        self.path, self.database, self.def_label, self.sort_species, self.db_changed,\
+        self.path, self.database, self.def_label, self.sort_species, self.db_changed, self.metadata_restat,\
         self.pred_path, self.prediction_thresh, self.observation_rank, self.iou_thresh = load_configs()
-        self.paths = []
         if os.path.exists(self.path):
-            for dirName, subdirList, fileList in os.walk(self.path):
-                self.paths += [os.path.relpath(os.path.join(dirName, x), self.path) for x in fileList if
-                               x.endswith('.jpg')
-                               or x.endswith('.jpeg') or x.endswith('.png')]
+            self.paths, annotation_files, self.dir_mtimes = scan_library(self.path, FILE_EXT, MANIFEST_FILE)
         else:
             raise IOError(LIB_PATH_ERROR)
+        self.metadata = PC15MetadataStore(self.path)
         if self.sort_species:
             self.paths = self.sort_by_species()
         else:
-            self.paths.sort()  # Use this line instead of above to sort by file name
+            self.paths = PathTable.from_paths(sorted(self.paths))  # Use this line instead of above to sort by file name
         print("There are {} images in this dataset.".format(len(self.paths)))
+        self.annotation_index = AnnotationIndex.build(self.paths, annotation_files, FILE_EXT)
+        self.iter = -1
         if os.path.exists(os.path.join('configurations', 'iter.txt')):
             with open(os.path.join('configurations', 'iter.txt'), 'r') as it:
                 self.iter = int(it.readline().strip()) - 1
-        else:
-            self.iter = -1
+                last_file = it.readline().strip()
+            # Resume from the same image even if the order of the dataset has changed since
+            last_ind = self.paths.find(last_file)
+            if last_ind >= 0:
+                self.iter = last_ind - 1
         self.k = None
+        # Index of the image loaded as self.k; self.iter moves on before the next image is loaded, which can fail
+        self.k_ind = None
         self.im_height = 0
         self.im_width = 0
         self.xml_dims = ()
         self.classes = load_classes()
-        self.od_instances = self.load_json_predictions()
-        self.annot = []
-        self.labels = []
-        self.prev_annot = []
-        self.prev_labels = []
+        # Label names of all images share one table, which starts with the classes in key binding order
+        self.label_table = LabelTable(self.classes)
+        self.od_predictions = self.load_json_predictions()
+        self.annotations = AnnotationStore(self.label_table)
+        self.class_colors = {}
+        for i in reversed(range(min(len(CLASS_COLORS), len(self.classes)))):
+            self.class_colors[self.label_table.id(self.classes[i])] = CLASS_COLORS[i]
+        self.draw_list = None
+        self.grid = None
+        self.grid_annotations = []
+        self.display = DisplayView()
+        self.mouse = None
+        self.prev_annotations = AnnotationStore(self.label_table)
         self.labels_on = True
         self.new_box = None
         self.hovered_point = None
         self.moving_point = None
         self.hovered_box = -1
+        self.box_index = None
         self.moving_box = None
         self.selected_box_width = None
         self.selected_box_height = None
         self.highlighted = False
         self.selected_annot = -1
-        # variable to determine if current image was annotated when opened, in order to updated counts appropriately
+        # variable to determine if current image was annotated when opened
         self.initially_annotated = None
+        self.image_cache = ImageCache(IMAGE_CACHE_BYTES)
+        self.thumbnails = ThumbnailCache()
+        self.annotation_writer = AnnotationWriter()
+        self.show_stats = False
+        self.instrumentation = load_instrumentation()
+        if self.instrumentation is not None:
+            self.instrumentation.instrument(self, INSTRUMENTED_METHODS)
+            self.instrumentation.add_counters('image_cache', self.image_cache.stats)
+        # While filter_on, navigation only visits images matching self.query; the index searched for them is only
+        # built once a filter is set
+        self.query = ImageQuery()
+        self.query_index = None
+        self.filter_on = False
+        if query:
+            self.apply_query(parse_query(query))
         self.load_next()
-        self.preserved_annotations = []
-        self.preserved_labels = []
-        self.annotated_images = self.get_annotations_count()
-
-    def calculate_iou_to_previous(self, pred_bbox):
-        max_iou = 0
-        adjusted_pb = [(int(pred_bbox[0]), int(pred_bbox[1])),
-                       (int(pred_bbox[0] + pred_bbox[2]), int(pred_bbox[1] + pred_bbox[3]))]
-        boxes = [self.prev_annot[i:i + 2] for i in range(0, len(self.prev_annot), 2)]
-        for i, box in enumerate(boxes):
-            area_1 = (adjusted_pb[1][0] - adjusted_pb[0][0]) * (adjusted_pb[1][1] - adjusted_pb[0][1])
-            area_2 = (box[1][0] - box[0][0]) * (box[1][1] - box[0][1])
-            intersection = (min(adjusted_pb[1][0], box[1][0]) - max(adjusted_pb[0][0], box[0][0])) * \
-                           (min(adjusted_pb[1][1], box[1][1]) - max(adjusted_pb[0][1], box[0][1]))
-            union = area_1 + area_2 - intersection
-            if union == 0:
-                iou = 0
-            else:
-                iou = intersection / union
-            max_iou = max(max_iou, iou)
-        return max_iou
 
     def load_json_predictions(self):
         if os.path.exists(self.pred_path):
-            with open(self.pred_path) as json_file:
-                instances = json.load(json_file)
-            return instances
+            return open_prediction_store(self.pred_path, self.prediction_thresh)
+        return PredictionIndex.empty()
 
+    # Annotations for the current image: those saved earlier with this tool, if any, or otherwise the suggestions
+    # made from the object detection predictions
     def load_json_annotations(self):
-        anns = []
-        lbls = []
-        if os.path.exists(os.path.join(self.path, self.k[:self.k.find('.')] + FILE_EXT)):
-            _, _, _, anns, lbls = load_from_voc_xml(self.path, self.k, FILE_EXT)
-        else:
-            for inst in range(len(self.od_instances)):
-                if self.od_instances[inst]['image_id'] == self.k[:self.k.find('.')] and \
-                        self.od_instances[inst]['score'] > self.prediction_thresh and \
-                        self.calculate_iou_to_previous(self.od_instances[inst]['bbox']) < self.iou_thresh:
-                    json_bbox = self.od_instances[inst]['bbox']
-                    anns.append([int(json_bbox[0]), int(json_bbox[1])])
-                    anns.append([int(json_bbox[0] + json_bbox[2]), int(json_bbox[1] + json_bbox[3])])
-                    lbls.append(self.classes[self.od_instances[inst]['category_id'] - 1])
-        return anns, lbls
-
-
+        if os.path.exists(self.get_annotation_path()):
+            return load_annotation_store(self.path, self.k, FILE_EXT, self.label_table)[1]
+        bboxes, scores, category_ids = self.od_predictions.get(self.paths.stem(self.k_ind))
+        keep = select_suggestions(bboxes, scores, self.prev_annotations.boxes, self.prediction_thresh, self.iou_thresh)
+        labels = [self.classes[category_id - 1] for category_id in category_ids[keep].tolist()]
+        return AnnotationStore.from_boxes(xywh_to_corners(bboxes[keep]), labels, self.label_table)
+
+    # Returns (height, width, depth) of the current image; never decodes the image to do so
     def get_image_dims(self):
-        img = cv2.imread(os.path.join(self.path, self.k))
-        return img.shape
+        return self.image_cache.image_dims(os.path.join(self.path, self.k), self.xml_dims)
 
     # If the current sample contains an empty annotation, remove
     # it from the annotation list and delete the annotation file
     def remove_zero_annotations(self):
-        if self.k is not None and self.annot == [] and os.path.exists(self.get_annotation_path()):
+        # Also called whenever the image is changed, so pending saves are written out first
+        self.annotation_writer.flush()
+        if self.k is not None and self.annotations.point_count() == 0 and os.path.exists(self.get_annotation_path()):
             os.remove(self.get_annotation_path())
+            self.annotation_index.mark(self.k_ind, False)
+            self.update_query_index()
 
     # NOTE: Specifically for PlantCLEF2015 data format - sorts into species and then metadata
-    # NOTE: This will only work as long as the jpgs and PlantCLEF xmls have not been modified since last use, or if
-    # the sort tag in the config file has not been edited
+    # NOTE: Only metadata files which are new or have changed since the last sort are read again; setting the
+    # 'DB_CHANGED:' tag in the config file forces every file to be re-read
+    # NOTE: Metadata files are only checked for changes in directories which changed since the last sort; setting the
+    # 'METADATA_RESTAT:' tag checks every file, which picks up files edited in place
     def sort_by_species(self):
-        species = {}
-        sorted_file = 'sorted_filenames_by_species.pkl'
-        if os.path.exists(sorted_file) and not self.db_changed:
-            sorted_pickle = open(sorted_file, 'rb')
-            return pickle.load(sorted_pickle)
-
-        else:
-            print('Sorting files for modified dataset...\nNote that this should only happen once.')
-            for ind, file in enumerate(self.paths):
-                file_species = ''
-                meta = ''
-                if os.path.exists(os.path.join(self.path, str(self.paths[ind][:self.paths[ind].find('.')]) + '.xml')):
-                    with open(os.path.join(self.path, str(self.paths[ind][:self.paths[ind].find('.')]) + '.xml'), 'r',
-                              encoding='utf-8') as f:
-                        for line in f.readlines():
-                            if line.strip().startswith('<Species>'):
-                                file_species = line.strip()[9:-10]
-                            if line.strip().startswith('<Content>'):
-                                meta = line.strip()[9:-10]
-                file_species = file_species + meta
-
-                species[self.paths[ind]] = file_species
-            sort_file_species = sorted(species.items(), key=lambda x: x[1])
-            sorted_pickle = open(sorted_file, 'wb')
-            sfs = np.asarray(sort_file_species)
-            if len(sfs.shape) > 1:
-                sfs = sfs[:, 0]
-            pickle.dump(sfs, sorted_pickle)
-            print('Completed.')
-            if os.path.exists(os.path.join('configurations', 'iter.txt')):
-                os.remove(os.path.join('configurations', 'iter.txt'))
-            return sfs
+        return sort_paths_by_species(self.path, self.paths, 'sorted_filenames_by_species.npz', self.metadata,
+                                     self.db_changed, dir_mtimes=self.dir_mtimes, check_all=self.metadata_restat)
 
     # Loads in the annotations/labels for the current image, including height and width
     def load_current_im_info(self):
-        # First, update annotated and unannotated count
-        if self.k is not None:
-            if os.path.exists(os.path.join(self.path, self.k[:self.k.find('.')] + FILE_EXT)):
-                if not self.initially_annotated:
-                    # print(self.initially_annotated)
-                    # print('currently false')
-                    self.annotated_images += 1
-            else:
-                if self.initially_annotated:
-                    # print('currently true')
-                    # print(self.initially_annotated)
-                    self.annotated_images -= 1
-
         self.k = self.paths[self.iter]
-        if os.path.exists(os.path.join(self.path, self.k[:self.k.find('.')] + FILE_EXT)):
-            self.initially_annotated = True
-            # print('set to true')
-        else:
-            self.initially_annotated = False
-            # print('set to false')
-        # print(self.k[:self.k.find('.')])
-
-        _, _, _, self.prev_annot, self.prev_labels = load_from_voc_xml(self.path, self.k, PREV_ANNOT_EXT)
-        anns, lbls = self.load_json_annotations()
-        self.annot = anns
-        self.labels = lbls
-        self.preserved_annotations = copy.deepcopy(anns)
-        self.preserved_labels = copy.deepcopy(lbls)
+        self.k_ind = self.iter
+        self.initially_annotated = bool(self.annotation_index.annotated[self.iter])
+        with timing(self.instrumentation, 'load_annotation_store'):
+            _, self.prev_annotations = load_annotation_store(self.path, self.k, PREV_ANNOT_EXT, self.label_table)
+        self.annotations = self.load_json_annotations()
+        self.preserved_annotations = self.annotations.snapshot()
         self.reset_highlight()
-        self.im_height = self.get_image_dims()[0]
-        self.im_width = self.get_image_dims()[1]
+        self.im_height, self.im_width, _ = self.get_image_dims()
+
+    # Displays the image at the current iteration, then queues decodes of its neighbours in the sort order so that
+    # they are ready by the time they are navigated to
+    def show_current_image(self):
+        path = os.path.join(self.path, self.paths[self.iter])
+        im = self.image_cache.get(path)
+        self.set_image(im)
+        self.display = DisplayView.for_image(self.image_cache.image_dims(path), im)
+        self.mouse = None
+        neighbours = []
+        for offset in range(1, PREFETCH_RANGE + 1):
+            neighbours.append(self.paths[(self.iter + offset) % len(self.paths)])
+            neighbours.append(self.paths[(self.iter - offset) % len(self.paths)])
+        self.image_cache.prefetch([os.path.join(self.path, p) for p in neighbours])
 
     def load_next(self):
         self.remove_zero_annotations()
+        if self.filter_on:
+            self.load_match(self.query_index.next_match(self.iter))
+            return
         self.iter += 1
         self.iter = self.iter % len(self.paths)
-        im = imageio.imread(os.path.join(self.path, self.paths[self.iter]))
-        self.set_image(im)
+        self.show_current_image()
         self.load_current_im_info()
 
     def load_prev(self):
         self.remove_zero_annotations()
+        if self.filter_on:
+            self.load_match(self.query_index.prev_match(self.iter))
+            return
         self.iter -= 1
         self.iter = (self.iter + len(self.paths)) % len(self.paths)
-        im = imageio.imread(os.path.join(self.path, self.paths[self.iter]))
-        self.set_image(im)
+        self.show_current_image()
         self.load_current_im_info()
 
-    def load_next_not_annotated(self):
+    # Moves straight to the image at index ind, without loading any of the images in between
+    def load_image_at(self, ind):
+        self.iter = ind
+        self.show_current_image()
+        self.load_current_im_info()
+
+    # Moves to the image at index ind found by a filtered search, or stays on the current image if there was none
+    def load_match(self, ind):
+        if ind < 0:
+            print('No other images match "{}"'.format(self.query))
+            return
+        self.load_image_at(ind)
+
+    # Index of the next image after the current one (or the previous one before it) whose annotation status matches
+    # annotated, out of the images matching the filter while it is on
+    def find_with_status(self, annotated, forward=True):
+        if self.filter_on:
+            candidates = self.annotation_index.annotated == annotated
+            if forward:
+                return self.query_index.next_match(self.iter, candidates)
+            return self.query_index.prev_match(self.iter, candidates)
+        if forward:
+            return self.annotation_index.find_next(self.iter, annotated)
+        return self.annotation_index.find_prev(self.iter, annotated)
+
+    # Moves to the next (or previous) image whose annotation status matches annotated, skipping images which can't
+    # be decoded. Gives up after trying every image once, staying on the image already shown.
+    def load_with_status(self, annotated, forward=True):
         self.remove_zero_annotations()
-        while True:
-            self.iter += 1
-            self.iter = self.iter % len(self.paths)
-            self.load_current_im_info()
-            if self.annot == [] or self.iter == 0:
-                break
-        try:
-            im = imageio.imread(os.path.join(self.path, self.paths[self.iter]))
-            self.set_image(im)
-        except ValueError:
-            self.load_next_not_annotated()
+        for _ in range(len(self.paths)):
+            try:
+                self.load_match(self.find_with_status(annotated, forward))
+                return
+            except ValueError as e:
+                print('WARNING: Skipping {}: {}'.format(self.paths[self.iter], e))
+        print('WARNING: No image could be decoded')
+        if self.k_ind is not None:
+            self.iter = self.k_ind
+
+    def load_next_not_annotated(self):
+        self.load_with_status(False)
 
     def load_next_annotated(self):
-        self.remove_zero_annotations()
-        while True:
-            self.iter += 1
-            self.iter = self.iter % len(self.paths)
-            self.load_current_im_info()
-            if not self.annot == [] or self.iter == 0:
-                break
-        try:
-            im = imageio.imread(os.path.join(self.path, self.paths[self.iter]))
-            self.set_image(im)
-        except ValueError:
-            self.load_next_not_annotated()
+        self.load_with_status(True)
 
     def load_prev_not_annotated(self):
-        self.remove_zero_annotations()
-        while True:
-            self.iter -= 1
-            self.iter = (self.iter + len(self.paths)) % len(self.paths)
-            self.load_current_im_info()
-            if self.annot == [] or self.iter == 0:
-                break
-        try:
-            im = imageio.imread(os.path.join(self.path, self.paths[self.iter]))
-            self.set_image(im)
-        except ValueError:
-            self.load_prev_not_annotated()
+        self.load_with_status(False, forward=False)
 
     def load_prev_annotated(self):
-        self.remove_zero_annotations()
-        while True:
-            self.iter -= 1
-            self.iter = (self.iter + len(self.paths)) % len(self.paths)
-            self.load_current_im_info()
-            if not self.annot == [] or self.iter == 0:
-                break
-        try:
-            im = imageio.imread(os.path.join(self.path, self.paths[self.iter]))
-            self.set_image(im)
-        except ValueError:
-            self.load_prev_not_annotated()
-
+        self.load_with_status(True, forward=False)
+
+    # Sets the filter which navigation is restricted to, switching it off if the query is empty or matches nothing.
+    # The index of every annotation file is built on first use.
+    def apply_query(self, query):
+        self.query = query
+        self.filter_on = not query.is_empty()
+        if not self.filter_on:
+            return
+        if self.query_index is None:
+            self.annotation_writer.flush()
+            print('Indexing annotations...')
+            self.query_index = QueryIndex.build(self.path, self.paths, FILE_EXT, self.annotation_index.annotated,
+                                                self.metadata, QUERY_CACHE_FILE)
+        matches = self.query_index.match(query)
+        print('{} images match "{}"'.format(len(matches), query))
+        if len(matches) == 0:
+            self.filter_on = False
+
+    # Keeps the query index in step with the annotations of the current image, as last saved
+    def update_query_index(self):
+        if self.query_index is not None:
+            self.query_index.update(self.k_ind, self.annotations.voc_boxes(), self.annotations.labels(),
+                                    int(self.observation_rank))
+
+    # Shown on screen while the filter is on
+    def query_status(self):
+        if not self.filter_on:
+            return None
+        return 'Filter: {} ({} images)'.format(self.query, len(self.query_index.matches))
+
+    # Queues the annotations to be written out. The writer gets a snapshot, so later edits can't reach the file it
+    # writes.
     def save_progress(self):
-        save_to_voc_xml(self.k, self.path, os.getcwd(), self.database, self.get_image_dims(),
-                        self.reset_annotation_boxes(), self.labels, FILE_EXT, self.observation_rank)
-        with open(os.path.join('configurations', 'iter.txt'), 'w') as it:
-            it.write(str(self.iter))
+        self.annotations.normalize()
+        self.annotation_writer.write(self.get_annotation_path(),
+                                     partial(voc_xml_string, self.k, self.path, os.getcwd(), self.database,
+                                             self.get_image_dims(), self.annotations.snapshot(), None,
+                                             self.observation_rank))
+        self.annotation_index.mark(self.k_ind, True)
+        self.update_query_index()
+        self.annotation_writer.write(os.path.join('configurations', 'iter.txt'), str(self.k_ind) + '\n' + self.k)
 
     def change_selected_label(self, key):
         num = int(key)
@@ -338,61 +382,80 @@ class App(anntoolkit.App):
             num = 9
         if num < len(self.classes):
             self.def_label = self.classes[num]
-            if len(self.labels) > 0:
-                self.labels[self.selected_annot] = self.classes[num]
+            if len(self.annotations) > 0:
+                self.annotations.set_label(self.selected_annot, self.classes[num])
                 self.save_progress()
 
     def rotate_annotations(self, heightwise=True):
-        for i in range(len(self.annot)):
-            old_x = self.annot[i][0]
-            old_y = self.annot[i][1]
-            if heightwise:
-                self.annot[i] = (self.im_height - old_y, old_x)
-            else:
-                self.annot[i] = (self.im_width - old_y, old_x)
+        self.annotations.rotate(self.im_height if heightwise else self.im_width)
+
+    # Switches between the whole image and a full-resolution region of it around what is in view, for images which
+    # are displayed at a reduced resolution
+    def toggle_detail_view(self):
+        if self.display.detail:
+            self.show_current_image()
+        elif self.display.reduced():
+            region = detail_region(self.visible_region(), self.im_width, self.im_height)
+            self.set_image(decode_region(os.path.join(self.path, self.k), region))
+            self.display = DisplayView.for_region(region)
+            self.mouse = None
+        self.new_box = None
+
+    # Shows the page of the overview grid holding image ind, queuing thumbnails for whatever it's missing and for the
+    # next page. The boxes of each image are drawn over its thumbnail by build_grid_draw_list.
+    def show_grid_page(self, ind):
+        first = ind % len(self.paths)
+        first -= first % GRID_PAGE_SIZE
+        names = self.paths[first:first + GRID_PAGE_SIZE]
+        paths = [os.path.join(self.path, p) for p in self.paths[first:first + 2 * GRID_PAGE_SIZE]]
+        completed = self.thumbnails.completed
+        thumbnails = [self.thumbnails.load(p) for p in paths[:len(names)]]
+        self.thumbnails.request([p for p, t in zip(paths, thumbnails) if t is None] + paths[len(names):])
+        self.grid = ThumbnailPage(first, thumbnails, completed)
+        self.grid_annotations = [load_annotation_store(self.path, k, FILE_EXT, self.label_table) for k in names]
+        self.set_image(self.grid.compose())
+        self.display = DisplayView()
+        self.mouse = None
+        self.new_box = None
+
+    # Shows the grid page again once any of the thumbnails it was missing have been made
+    def refresh_grid_page(self):
+        if self.grid.missing and self.thumbnails.completed != self.grid.completed:
+            self.grid.completed = self.thumbnails.completed
+            if any(self.thumbnails.cached(os.path.join(self.path, self.paths[self.grid.first + i]))
+                   for i in self.grid.missing):
+                self.show_grid_page(self.grid.first)
+
+    # Part of the image in view as (xmin, ymin, xmax, ymax) in image pixels, worked out from the last mouse position;
+    # the whole image until the mouse has moved over it
+    def visible_region(self):
+        if self.mouse is None:
+            return 0, 0, self.im_width, self.im_height
+        x, y, lx, ly = self.mouse
+        x0, y0 = self.display.to_image(lx - x / self.scale, ly - y / self.scale)
+        x1, y1 = self.display.to_image(lx + (self.width - x) / self.scale, ly + (self.height - y) / self.scale)
+        return x0, y0, x1, y1
+
+    # Position (x, y) limited to the bounds of the current image
+    def clamp_to_image(self, x, y):
+        return min(max(0, x), self.im_width), min(max(0, y), self.im_height)
 
     # Created due to fact that this appears in multiple locations: changing
     # dataset layout may require referencing a file's full path differently
     def get_annotation_path(self):
-        return os.path.join(self.path, str(self.k[:self.k.find('.')]) + FILE_EXT)
+        return os.path.join(self.path, self.paths.annotation_path(self.k_ind, FILE_EXT))
 
     # NOTE: This is specifically used for PlantCLEF 2015 dataset format
     def get_PC15_metadata_category(self):
-        xml = os.path.join(self.path, str(self.k[:self.k.find('.')]) + '.xml')
-        if os.path.exists(xml):
-            with open(xml, 'r', encoding='utf-8') as x:
-                for line in x.readlines():
-                    if line.strip().startswith('<Content>'):
-                        return line.strip()[9:-10]
-            return '**no image label found**'
-        return '**no metadata xml file found**'
+        return self.metadata.content(self.k)
 
     def get_PC15_species(self):
-        xml = os.path.join(self.path, str(self.k[:self.k.find('.')]) + '.xml')
-        if os.path.exists(xml):
-            with open(xml, 'r', encoding='utf-8') as x:
-                for line in x.readlines():
-                    if line.strip().startswith('<Species>'):
-                        return line.strip()[9:-10]
-            return '**no image species found**'
-        return '**no metadata xml file found**'
-
-    def get_annotations_count(self):
-        annotated = 0
-        for file in os.listdir(self.path):
-            if file.endswith('.jpg') or file.endswith('.png') or file.endswith('.jpeg'):
-                if os.path.exists(os.path.join(self.path, file[:file.find('.')] + FILE_EXT)):
-                    annotated += 1
-        return annotated
-
-    # Returns a list of the opposite corners of the original annotations, which is used to
+        return self.metadata.species(self.k)
+
+    # Returns the opposite corners of the annotations (two per box, as an array of points), which is used to
     # create the second pair of points for each bounding box
     def get_ann_opposite_corners(self):
-        opposite_corners = []
-        for i in range(0, len(self.annot) - 1, 2):
-            opposite_corners.append((self.annot[i][0], self.annot[i + 1][1]))
-            opposite_corners.append((self.annot[i + 1][0], self.annot[i][1]))
-        return opposite_corners
+        return self.annotations.boxes[:, [0, 3, 2, 1]].reshape(-1, 2)
 
     # Resets variables when highlight is no longer visible: sets the selected annotation as the last one
     def reset_highlight(self):
@@ -400,102 +463,128 @@ class App(anntoolkit.App):
         self.moving_point = None
         self.highlighted = False
         self.hovered_box = -1
-        if len(self.annot) > 0:
-            self.selected_annot = int(len(self.annot) / 2) - 1
+        if self.annotations.point_count() > 0:
+            self.selected_annot = len(self.annotations) - 1
         else:
             self.selected_annot = 0
 
-    # Resets each bounding box within the current image to prepare for Pascal VOC format - dimensions are rounded
-    # to integers and smaller values of x and y are placed in first point, larger values in second point
-    def reset_annotation_boxes(self):
-        annotation_k = self.annot
-        reset_annotation = []
-        for i in range(0, len(annotation_k) - 1, 2):
-            xmin = int(round(min(annotation_k[i][0], annotation_k[i + 1][0])))
-            xmax = int(round(max(annotation_k[i][0], annotation_k[i + 1][0])))
-            ymin = int(round(min(annotation_k[i][1], annotation_k[i + 1][1])))
-            ymax = int(round(max(annotation_k[i][1], annotation_k[i + 1][1])))
-            reset_annotation.append((xmin, ymin))
-            reset_annotation.append((xmax, ymax))
-        if len(annotation_k) % 2 == 1:
-            reset_annotation.append((int(round(annotation_k[-1][0])), int(round(annotation_k[-1][1]))))
-        self.annot = reset_annotation
-        return reset_annotation
-
     # Useful if for some reason annotations and labels need to be reset to the values when loaded in
     def undo_current_image_changes(self):
         self.moving_point = None
-        self.annot = copy.deepcopy(self.preserved_annotations)
-        self.labels = copy.deepcopy(self.preserved_labels)
-
-    # Called once per frame. This is where things (including labels) are drawn on the image.
-    def on_update(self):
-        self.text("Image %d / %d" % (self.iter + 1, len(self.paths)), 10, 30)
-        self.text(self.k, 10, 60)
-        self.text("Species: %s" % self.get_PC15_species(), 10, 90)
-        self.text("Metadata category: %s" % self.get_PC15_metadata_category(), 10, 120)
-        self.text("Current label: {}".format(self.def_label), 10, 150)
-        self.text("Points count: %d" % len(self.annot), 10, 180)
-        self.text("%s" % str(self.initially_annotated), 10, 300)
-        self.text("Images in dataset: %d" % len(self.paths), self.width - 10, 30, alignment=anntoolkit.Alignment.Right)
-        self.text("Annotated images: %d" % self.annotated_images, self.width - 10, 60, alignment=anntoolkit.Alignment.Right)
-        self.text("Unannotated/unchanged images: %d" % (len(self.paths) - self.annotated_images), self.width - 10, 90, alignment=anntoolkit.Alignment.Right)
-        self.text("Key bindings:", self.width - 10, 140, alignment=anntoolkit.Alignment.Right)
+        self.annotations = self.preserved_annotations.snapshot()
+
+    # Everything on_update draws, other than the box being drawn, depends only on this; the draw list is rebuilt
+    # whenever it changes
+    def render_state(self):
+        return (self.iter, self.annotations.version, self.prev_annotations.version, self.def_label,
+                self.initially_annotated, self.annotation_index.count, self.hovered_point, self.hovered_box,
+                self.selected_annot, self.highlighted, self.labels_on, self.width, self.scale, self.display, self.grid,
+                self.query_status())
+
+    # Records what on_update draws for the current state. This is where things (including labels) are drawn on the
+    # image.
+    def build_draw_list(self):
+        draw = DrawList(self.render_state())
+        right = anntoolkit.Alignment.Right
+        draw.add(self.text, "Image %d / %d" % (self.iter + 1, len(self.paths)), 10, 30)
+        draw.add(self.text, self.k, 10, 60)
+        draw.add(self.text, "Species: %s" % self.get_PC15_species(), 10, 90)
+        draw.add(self.text, "Metadata category: %s" % self.get_PC15_metadata_category(), 10, 120)
+        draw.add(self.text, "Current label: {}".format(self.def_label), 10, 150)
+        draw.add(self.text, "Points count: %d" % self.annotations.point_count(), 10, 180)
+        if self.query_status() is not None:
+            draw.add(self.text, self.query_status(), 10, 210)
+        draw.add(self.text, "%s" % str(self.initially_annotated), 10, 300)
+        draw.add(self.text, "Images in dataset: %d" % len(self.paths), self.width - 10, 30, alignment=right)
+        draw.add(self.text, "Annotated images: %d" % self.annotation_index.count, self.width - 10, 60, alignment=right)
+        draw.add(self.text, "Unannotated/unchanged images: %d" % (len(self.paths) - self.annotation_index.count),
+                 self.width - 10, 90, alignment=right)
+        draw.add(self.text, "Key bindings:", self.width - 10, 140, alignment=right)
         for i, c in enumerate(self.classes):
-            self.text("{} - {}".format(i + 1, c), self.width - 10, 170 + i * 30, alignment=anntoolkit.Alignment.Right)
-        for i, p in enumerate(self.annot):
+            draw.add(self.text, "{} - {}".format(i + 1, c), self.width - 10, 170 + i * 30, alignment=right)
+        for i, p in enumerate(self.display.to_display(self.annotations.points()).tolist()):
             if i == self.hovered_point:
-                self.point(*p, (127, 127, 255, 159), radius=self.POINT_RADIUS * self.scale)
-            self.point(*p, (255, 0, 0, 250))
-        for i, p in enumerate(self.get_ann_opposite_corners()):
-            self.point(*p, (255, 0, 0, 250))
-
-        boxes = [self.annot[i:i + 2] for i in range(0, len(self.annot), 2)]
-        for i, box in enumerate(boxes):
-            if len(box) == 2:
-                if self.hovered_box == i:
-                    self.box(box, (255, 255, 255, 255), (255, 255, 255, 50))
-                if self.selected_annot == i and self.highlighted:  # When we are on selected box
-                    self.box(box, (255, 255, 255, 255), (255, 255, 255, 128))
-                # Colors implemented for first 5 labels. More can be implemented if desired; can also change colors
-                elif self.labels[i] == self.classes[0]:
-                    self.box(box, (0, 255, 0, 0), (0, 255, 0, 120))
-                elif self.labels[i] == self.classes[1]:
-                    self.box(box, (255, 0, 0, 0), (255, 0, 0, 120))
-                elif self.labels[i] == self.classes[2]:
-                    self.box(box, (249, 21, 218, 0), (249, 21, 218, 120))
-                elif self.labels[i] == self.classes[3]:
-                    self.box(box, (127, 127, 127, 0), (1, 50, 32, 120))
-                elif self.labels[i] == self.classes[4]:
-                    self.box(box, (1, 50, 32, 120), (1, 50, 32, 180))
-                else:
-                    self.box(box, (0, 255, 0, 250), (100, 255, 100, 120))
-                if self.labels_on:
-                    box = reset_box(box)
-                    self.text_loc(self.labels[i], *box[0], (0, 10, 0, 250), (150, 255, 150, 255))
+                draw.add(self.point, *p, (127, 127, 255, 159), radius=self.POINT_RADIUS * self.scale)
+            draw.add(self.point, *p, (255, 0, 0, 250))
+        for p in self.display.to_display(self.get_ann_opposite_corners()).tolist():
+            draw.add(self.point, *p, (255, 0, 0, 250))
+
+        labels = self.annotations.labels()
+        boxes = self.display.to_display(self.annotations.boxes).reshape(-1, 4).tolist()
+        for i, ((x0, y0, x1, y1), class_id) in enumerate(zip(boxes, self.annotations.class_ids.tolist())):
+            box = [(x0, y0), (x1, y1)]
+            if self.hovered_box == i:
+                draw.add(self.box, box, (255, 255, 255, 255), (255, 255, 255, 50))
+            if self.selected_annot == i and self.highlighted:  # When we are on selected box
+                draw.add(self.box, box, (255, 255, 255, 255), (255, 255, 255, 128))
+            else:
+                draw.add(self.box, box, *self.class_colors.get(class_id, OTHER_CLASS_COLORS))
+            if self.labels_on:
+                draw.add(self.text_loc, labels[i], min(x0, x1), min(y0, y1), (0, 10, 0, 250), (150, 255, 150, 255))
+        prev_labels = self.prev_annotations.labels()
+        prev_boxes = self.display.to_display(self.prev_annotations.boxes).reshape(-1, 4).tolist()
+        for i, (x0, y0, x1, y1) in enumerate(prev_boxes):
+            draw.add(self.box, [(x0, y0), (x1, y1)], (255, 255, 255, 127), (255, 255, 255, 85))
+            if self.labels_on:
+                draw.add(self.text_loc, prev_labels[i], x0, y0, (0, 10, 0, 250), (150, 150, 150, 150))
+        return draw
+
+    # Records what on_update draws over a page of the overview grid: each image's boxes on its thumbnail, and a frame
+    # around the current image
+    def build_grid_draw_list(self):
+        draw = DrawList(self.render_state())
+        draw.add(self.text, "Images %d - %d / %d" % (self.grid.first + 1, self.grid.first + len(self.grid),
+                                                     len(self.paths)), 10, 30)
+        draw.add(self.text, "Click an image to open it", 10, 60)
+        for i, (xml_dims, annotations) in enumerate(self.grid_annotations):
+            if self.grid.thumbnails[i] is None or not xml_dims:
+                continue
+            boxes = self.grid.cell_boxes(i, annotations.boxes, xml_dims[0])
+            for (x0, y0, x1, y1), class_id in zip(boxes.tolist(), annotations.class_ids.tolist()):
+                draw.add(self.box, [(x0, y0), (x1, y1)], *self.class_colors.get(class_id, OTHER_CLASS_COLORS))
+        if self.grid.first <= self.iter < self.grid.first + len(self.grid):
+            x, y = self.grid.cell_origin(self.iter - self.grid.first)
+            draw.add(self.box, [(x - 3, y - 3), (x + THUMBNAIL_SIDE + 3, y + THUMBNAIL_SIDE + 3)], (255, 255, 255, 255),
+                     (255, 255, 255, 0))
+        return draw
+
+    # Called once per frame. Replays the draw list, which is only worked out again when something shown has changed.
+    def on_update(self):
+        if self.grid is not None:
+            self.refresh_grid_page()
+        if self.draw_list is None or self.draw_list.key != self.render_state():
+            self.draw_list = self.build_draw_list() if self.grid is None else self.build_grid_draw_list()
+        self.draw_list.replay()
         if self.new_box:
             self.box(*self.new_box)
-        prev_boxes = [self.prev_annot[i:i + 2] for i in range(0, len(self.prev_annot), 2)]
-        for i, box in enumerate(prev_boxes):
-            if len(box) == 2:
-                self.box(box, (255, 255, 255, 127), (255, 255, 255, 85))
-                if self.labels_on:
-                    self.text_loc(self.prev_labels[i], *box[0], (0, 10, 0, 250), (150, 150, 150, 150))
-
+        if self.instrumentation is not None:
+            if self.show_stats:
+                lines = self.instrumentation.overlay_lines()
+                for i, line in enumerate(lines):
+                    self.text(line, 10, self.height - 10 - 30 * (len(lines) - 1 - i))
+            self.instrumentation.maybe_dump(library=self.path, images=len(self.paths))
+
+    # Mouse positions (lx, ly) come in displayed pixels and are mapped to image pixels first thing, which everything
+    # else works in
     def on_mouse_button(self, down, x, y, lx, ly):
+        lx, ly = self.display.to_image(lx, ly)
+        # Clicking a thumbnail of the overview grid opens its image
+        if self.grid is not None:
+            ind = self.grid.image_at(lx, ly)
+            if not down and ind >= 0:
+                self.grid = None
+                self.load_image_at(ind)
+            return
         # Upon click
         if down:
             if not self.new_box:
                 if self.hovered_point is not None:
                     self.moving_point = self.hovered_point
                 elif self.hovered_box >= 0:
-                    lower_diff = np.subtract((lx, ly), self.annot[self.hovered_box * 2])
-                    upper_diff = np.subtract((lx, ly), self.annot[self.hovered_box * 2 + 1])
-                    self.moving_box = [lower_diff, upper_diff]
-                    self.selected_box_width = self.annot[self.hovered_box * 2 + 1][0] - \
-                                              self.annot[self.hovered_box * 2][0]
-                    self.selected_box_height = self.annot[self.hovered_box * 2 + 1][1] - \
-                                               self.annot[self.hovered_box * 2][1]
+                    x0, y0, x1, y1 = self.annotations.boxes[self.hovered_box].tolist()
+                    self.moving_box = [np.subtract((lx, ly), (x0, y0)), np.subtract((lx, ly), (x1, y1))]
+                    self.selected_box_width = x1 - x0
+                    self.selected_box_height = y1 - y0
                     self.selected_annot = self.hovered_box
                     self.highlighted = True
 
@@ -507,23 +596,25 @@ class App(anntoolkit.App):
                 self.save_progress()
                 self.selected_box_height, self.selected_box_width = None, None
             elif self.moving_point is not None:
-                self.annot[self.moving_point] = (min(max(0, lx), self.im_width), min(max(0, ly), self.im_height))
+                self.annotations.set_point(self.moving_point, self.clamp_to_image(lx, ly))
                 self.moving_point = None
                 self.save_progress()
                 self.hovered_point = None
             else:
-                self.annot.append((min(max(0, lx), self.im_width), min(max(0, ly), self.im_height)))
-                if len(self.annot) % 2 == 0:
+                if self.annotations.add_point(self.clamp_to_image(lx, ly), self.def_label):
                     self.reset_highlight()
                     self.new_box = None
-                    self.labels.append(self.def_label)
                     self.save_progress()
 
     # Whenever the mouse changes position
     def on_mouse_position(self, x, y, lx, ly):
+        self.mouse = (x, y, lx, ly)
+        lx, ly = self.display.to_image(lx, ly)
+        if self.grid is not None:
+            return
         # Dragging point
         if self.moving_point is not None:
-            self.annot[self.moving_point] = (min(max(0, lx), self.im_width), min(max(0, ly), self.im_height))
+            self.annotations.set_point(self.moving_point, self.clamp_to_image(lx, ly))
         # Highlight hovered box: smallest box hovered will be highlighted
         elif self.moving_box is not None:
             # Limits movement of box to the inner bounds of the image
@@ -531,54 +622,41 @@ class App(anntoolkit.App):
             lower_y = min(max(0, ly - self.moving_box[0][1]), self.im_height - self.selected_box_height)
             upper_x = min(max(self.selected_box_width, lx - self.moving_box[1][0]), self.im_width)
             upper_y = min(max(self.selected_box_height, ly - self.moving_box[1][1]), self.im_height)
-            self.annot[self.hovered_box * 2] = (lower_x, lower_y)
-            self.annot[self.hovered_box * 2 + 1] = (upper_x, upper_y)
+            self.annotations.set_box(self.hovered_box, (lower_x, lower_y, upper_x, upper_y))
         elif not self.new_box:
+            if self.box_index is None or not self.box_index.matches(self.annotations):
+                self.box_index = BoxIndex(self.annotations)
             # Hovering box
-            hovered_box_boxes = {}
-            boxes = [self.annot[i:i + 2] for i in range(0, len(self.annot) - 1, 2)]
-            for i, b in enumerate(boxes):
-                b_xmin = min(b[0][0], b[1][0])
-                b_ymin = min(b[0][1], b[1][1])
-                b_xmax = max(b[0][0], b[1][0])
-                b_ymax = max(b[0][1], b[1][1])
-                if b_xmin <= lx <= b_xmax and b_ymin <= ly <= b_ymax:
-                    x = b_xmax - b_xmin
-                    y = b_ymax = b_ymin
-                    hovered_box_boxes[i] = x * y
-            if hovered_box_boxes:  # Finds index of the smallest hovered box
-                self.hovered_box = list(hovered_box_boxes.keys())[
-                    list(hovered_box_boxes.values()).index(min(list(hovered_box_boxes.values())))]
-            else:
-                self.hovered_box = -1
+            self.hovered_box = self.box_index.box_at(lx, ly)
             # Hovering point
-            points = np.asarray(self.annot)
-            opposite_points = np.asarray(self.get_ann_opposite_corners())
-            if len(opposite_points) > 0:
-                point = np.asarray([[lx, ly]])
-                d_p = points - point
-                d_p = np.linalg.norm(d_p, axis=1)
-                ind_p = np.argmin(d_p)
-                d_op = opposite_points - point
-                d_op = np.linalg.norm(d_op, axis=1)
-                ind_op = np.argmin(d_op)
-                if d_p[ind_p] < d_op[ind_op] and d_p[ind_p] < self.POINT_RADIUS:
-                    self.hovered_point = ind_p
-                elif d_op[ind_op] < self.POINT_RADIUS:
-                    self.hovered_point = ind_op
-                    ind_op = int(ind_op / 2) * 2  # Round down to even number
-                    self.annot[ind_op] = opposite_points[ind_op]
-                    self.annot[ind_op + 1] = opposite_points[ind_op + 1]
-                else:
+            if len(self.box_index) > 0:
+                corner = self.box_index.nearest_corner(lx, ly, self.POINT_RADIUS * self.display.pixel_size())
+                if corner is None:
                     self.hovered_point = None
-        if len(self.annot) % 2 == 1:
+                elif not corner[1]:
+                    self.hovered_point = corner[0]
+                else:
+                    # Makes the hovered opposite corner one of the box's own points
+                    self.hovered_point = corner[0]
+                    self.annotations.flip_corners(corner[0] // 2)
+        if self.annotations.pending is not None:
             self.new_box = [
-                [self.annot[-1], (min(max(0, lx), self.im_width), min(max(0, ly), self.im_height))],
+                self.display.to_display([self.annotations.pending, self.clamp_to_image(lx, ly)]).tolist(),
                 (0, 0, 255, 95), (0, 0, 255, 127)]
         else:
             self.new_box = None
 
     def on_keyboard(self, key, down, mods):
+        # The overview grid pages through the library, and goes back to the current image on 'G'
+        if down and self.grid is not None:
+            if key == anntoolkit.KeyLeft or key == 'A':
+                self.show_grid_page(self.grid.first - 1)
+            elif key == anntoolkit.KeyRight or key == 'D':
+                self.show_grid_page(self.grid.first + GRID_PAGE_SIZE)
+            elif key == 'G':
+                self.grid = None
+                self.show_current_image()
+            return
         if down:
             if key == anntoolkit.KeyLeft or key == 'A':
                 self.save_progress()
@@ -599,44 +677,68 @@ class App(anntoolkit.App):
             elif key == '.':
                 self.load_next_annotated()
             elif key == anntoolkit.KeyDelete:
-                self.annot = []
-                self.labels = []
+                self.annotations.clear()
+                self.annotation_writer.cancel(self.get_annotation_path())
                 if os.path.exists(self.get_annotation_path()):
                     os.remove(self.get_annotation_path())
+                # Also covers a save which was cancelled before it was ever written
+                self.annotation_index.mark(self.k_ind, False)
+                self.update_query_index()
                 self.reset_highlight()
             elif key == anntoolkit.KeyBackspace or key == ' ':
-                if self.highlighted and len(self.annot) > 1:
+                if self.highlighted and self.annotations.point_count() > 1:
                     # print(self.selected_annot)
-                    self.annot.pop(self.selected_annot * 2)
-                    self.annot.pop(self.selected_annot * 2)
-                    self.labels.pop(self.selected_annot)
+                    self.annotations.remove_box(self.selected_annot)
                     # self.selected_annot -= 1
                     self.reset_highlight()
                     self.save_progress()
+
                 else:
-                    if len(self.annot) > 0:
-                        self.annot = self.annot[:-1]
-                    if len(self.annot) % 2 == 1:
-                        self.annot.pop()
-                        self.labels.pop()
+                    # Removes the corner of the box being drawn or, failing that, the last box
+                    if self.annotations.pending is not None:
+                        self.annotations.clear_pending()
+                    elif len(self.annotations) > 0:
+                        self.annotations.remove_box(-1)
                         self.new_box = None
                         self.save_progress()
                         self.reset_highlight()
             elif key == 'T':  # 'T' to toggle the labels on or off
                 self.labels_on = not self.labels_on
+            elif key == 'Z':  # 'Z' to switch between the whole image and a full-resolution region of it
+                self.toggle_detail_view()
+            elif key == 'G':  # 'G' to show the overview grid of thumbnails
+                self.remove_zero_annotations()
+                self.show_grid_page(self.iter)
+            elif key == 'M':  # 'M' to toggle the timings overlay, when instrumentation is switched on
+                self.show_stats = not self.show_stats
+            elif key == 'F':  # 'F' to switch the navigation filter (see --query) on or off
+                if self.filter_on:
+                    self.filter_on = False
+                elif self.query.is_empty():
+                    print('No filter set: press C or H, or start with --query')
+                else:
+                    self.apply_query(self.query)
+            elif key == 'C':  # 'C' to filter by the current label, or stop filtering by class if already doing so
+                class_name = None if self.query.class_name == self.def_label else self.def_label
+                self.apply_query(self.query.replace(class_name=class_name))
+            elif key == 'H':  # 'H' to filter by the current image's species, or stop filtering by species
+                species = self.metadata.species(self.k)
+                if self.query.species is not None or species == NO_XML_MSG:
+                    species = None
+                self.apply_query(self.query.replace(species=species))
             elif str(key).isnumeric():
                 self.highlighted = False
                 self.change_selected_label(key)
             elif key == 'Q':
-                if int(len(self.annot)) > 1:
+                if self.annotations.point_count() > 1:
                     self.highlighted = True
                     self.selected_annot -= 1
-                    self.selected_annot = (int(len(self.annot) / 2) + self.selected_annot) % int(len(self.annot) / 2)
+                    self.selected_annot = (len(self.annotations) + self.selected_annot) % len(self.annotations)
             elif key == 'E':
-                if int(len(self.annot)) > 1:
+                if self.annotations.point_count() > 1:
                     self.highlighted = True
                     self.selected_annot += 1
-                    self.selected_annot = self.selected_annot % int(len(self.annot) / 2)
+                    self.selected_annot = self.selected_annot % len(self.annotations)
             elif key == 'U':
                 self.rotate_annotations(heightwise=False)
                 self.save_progress()
@@ -646,9 +748,22 @@ class App(anntoolkit.App):
             elif key == 'P':
                 self.undo_current_image_changes()
                 self.save_progress()
-                self.load_json_annotations()
+
+    def run(self):
+        try:
+            super(App, self).run()
+        finally:
+            self.image_cache.close()
+            self.thumbnails.close()
+            self.annotation_writer.close()
+            if self.instrumentation is not None:
+                self.instrumentation.dump(library=self.path, images=len(self.paths))
 
 
 if __name__ == '__main__':
-    snappy_annotator = App()
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--query', help="only navigate between images matching a filter, e.g. "
+                                        "'class=flower boxes>3 size<20 species=Acer campestre L. rank=1'")
+    args = parser.parse_args()
+    snappy_annotator = App(query=args.query)
     snappy_annotator.run()
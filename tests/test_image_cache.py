@@ -0,0 +1,129 @@
+"""
+Decoding through image_cache, in particular of files which can't be decoded, which the apps skip on ValueError
+"""
+
+import os
+import sys
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_cache
+from image_cache import ImageCache, decode_image, decode_region, open_image, probe_image_dims
+
+
+def jpeg_bytes(width=64, height=48):
+    buffer = io.BytesIO()
+    Image.fromarray(np.full((height, width, 3), 128, dtype=np.uint8)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = {}
+    paths['good'] = str(tmp_path / 'good.jpg')
+    with open(paths['good'], 'wb') as f:
+        f.write(jpeg_bytes())
+    paths['truncated'] = str(tmp_path / 'truncated.jpg')
+    with open(paths['truncated'], 'wb') as f:
+        f.write(jpeg_bytes()[:300])
+    paths['garbage'] = str(tmp_path / 'garbage.png')
+    with open(paths['garbage'], 'wb') as f:
+        f.write(b'not an image at all' * 10)
+    paths['missing'] = str(tmp_path / 'missing.jpg')
+    return paths
+
+
+def test_decode_image(images):
+    im, dims = decode_image(images['good'])
+    assert im.shape == (48, 64, 3)
+    assert dims == (48, 64, 3)
+
+
+@pytest.mark.parametrize('name', ['truncated', 'garbage', 'missing'])
+def test_undecodable_files_raise_value_error(images, name):
+    with pytest.raises(ValueError):
+        decode_image(images[name])
+    with pytest.raises(ValueError):
+        decode_image(images[name], max_side=16)
+
+
+@pytest.mark.parametrize('name', ['truncated', 'garbage'])
+def test_image_cache_raises_value_error(images, name):
+    cache = ImageCache(workers=1)
+    try:
+        with pytest.raises(ValueError):
+            cache.get(images[name])
+        # A failed prefetch raises the same way once the image is asked for
+        cache.prefetch([images[name]])
+        with pytest.raises(ValueError):
+            cache.get(images[name])
+        assert cache.get(images['good']).shape == (48, 64, 3)
+    finally:
+        cache.close()
+
+
+# Only the header of a file is read to open it, so a header claiming a very large image is enough to test the limits
+def test_open_image_limit(tmp_path):
+    path = str(tmp_path / 'huge.pgm')
+    with open(path, 'wb') as f:
+        f.write(b'P5\n20000 10000\n255\n')
+    limit = Image.MAX_IMAGE_PIXELS
+    with pytest.raises(Image.DecompressionBombError):
+        Image.open(path)
+    assert probe_image_dims(path) == (10000, 20000, 1)
+    with open_image(path) as im:
+        assert im.size == (20000, 10000)
+        assert Image.MAX_IMAGE_PIXELS == limit
+    with pytest.raises(Image.DecompressionBombError):
+        open_image(path, max_pixels=10 ** 8)
+    with pytest.raises(ValueError):
+        decode_image(path)
+
+
+def noise_image(path, width=300, height=200, seed=0):
+    pixels = np.random.RandomState(seed).randint(0, 256, (height, width, 3)).astype(np.uint8)
+    Image.fromarray(pixels).save(path)
+    with Image.open(path) as im:
+        return np.asarray(im.convert('RGB'))
+
+
+def test_decode_region(tmp_path):
+    cache_dir = str(tmp_path / 'regions')
+    for name in ['a.png', 'b.tif']:
+        pixels = noise_image(str(tmp_path / name))
+        for region in [(10, 20, 110, 70), (0, 0, 300, 200), (250, 150, 300, 200)]:
+            x0, y0, x1, y1 = region
+            assert (decode_region(str(tmp_path / name), region, cache_dir) == pixels[y0:y1, x0:x1]).all()
+    # The PNG needed a copy; the uncompressed TIFF was read in place
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 1
+
+
+# Copies are kept within the byte budget, least recently used first out, and leftover temporary files are removed
+def test_region_cache_budget(tmp_path):
+    cache_dir = str(tmp_path / 'regions')
+    paths = [str(tmp_path / '{}.png'.format(i)) for i in range(3)]
+    images = [noise_image(p, seed=i) for i, p in enumerate(paths)]
+    copy_bytes = 300 * 200 * 3 + 128
+    os.makedirs(cache_dir)
+    stale = os.path.join(cache_dir, 'interrupted.npy.tmp.npy')
+    with open(stale, 'wb') as f:
+        f.write(b'x' * 1000)
+    old = time.time() - image_cache.REGION_TMP_MAX_AGE - 1
+    os.utime(stale, (old, old))
+    for path, pixels in zip(paths, images):
+        assert (decode_region(path, (5, 5, 50, 50), cache_dir, 2 * copy_bytes) == pixels[5:50, 5:50]).all()
+    copies = [f for f in os.listdir(cache_dir) if f.endswith('.npy')]
+    assert len(copies) == 2
+    assert not os.path.exists(stale)
+    assert sum(os.path.getsize(os.path.join(cache_dir, f)) for f in copies) <= 2 * copy_bytes
+    assert not os.path.exists(image_cache.region_cache_path(paths[0], cache_dir))
+
+    # Without room for a copy at all, regions are still decoded, from the whole image
+    assert (decode_region(paths[0], (0, 0, 30, 40), cache_dir, 1000) == images[0][:40, :30]).all()
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 2
@@ -0,0 +1,162 @@
+"""
+Round trips of Pascal VOC files through voc_save_load, checked against files built and read with ElementTree and
+minidom, which is how the annotators wrote and read them before voc_save_load wrote them as text
+"""
+
+import os
+import sys
+import xml.etree.ElementTree as et
+from xml.dom import minidom
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annotation_store import AnnotationStore
+from voc_save_load import voc_xml_string, save_to_voc_xml, parse_voc_xml, parse_own_voc_xml, parse_any_voc_xml, \
+    load_voc_boxes, load_from_voc_xml, NO_RANK
+
+DIMS = (600, 800, 3)
+BOXES = [(10, 20, 110, 220), (0, 0, 799, 599), (-5, 3, 40, 41)]
+LABELS = ['flower', 'leaf', 'fruit']
+
+
+# The file as the annotators originally wrote it: built with ElementTree and pretty-printed with minidom
+def minidom_voc_xml(filename, folder, path, database, dims, boxes, labels, observation_rank):
+    xml = et.Element('annotation')
+    et.SubElement(xml, 'folder').text = folder
+    et.SubElement(xml, 'filename').text = filename
+    et.SubElement(xml, 'path').text = path
+    src = et.SubElement(xml, 'source')
+    et.SubElement(src, 'database').text = database
+    sz = et.SubElement(xml, 'size')
+    et.SubElement(sz, 'width').text = str(dims[1])
+    et.SubElement(sz, 'height').text = str(dims[0])
+    et.SubElement(sz, 'depth').text = str(dims[2])
+    for (xmin, ymin, xmax, ymax), label in zip(boxes, labels):
+        obj = et.SubElement(xml, 'object')
+        et.SubElement(obj, 'name').text = label
+        et.SubElement(obj, 'pose').text = 'Unspecified'
+        et.SubElement(obj, 'truncated').text = '0'
+        et.SubElement(obj, 'difficult').text = '0'
+        et.SubElement(obj, 'observation_rank').text = str(observation_rank)
+        bndbox = et.SubElement(obj, 'bndbox')
+        et.SubElement(bndbox, 'xmin').text = str(xmin)
+        et.SubElement(bndbox, 'ymin').text = str(ymin)
+        et.SubElement(bndbox, 'xmax').text = str(xmax)
+        et.SubElement(bndbox, 'ymax').text = str(ymax)
+    return minidom.parseString(et.tostring(xml, 'utf-8')).toprettyxml(indent='\t')
+
+
+def corner_points(boxes):
+    points = []
+    for xmin, ymin, xmax, ymax in boxes:
+        points += [(xmin, ymin), (xmax, ymax)]
+    return points
+
+
+def assert_parsed(parsed, path, database, dims, boxes, labels, ranks):
+    assert parsed[0] == path
+    assert parsed[1] == database
+    assert parsed[2] == (dims[1], dims[0], dims[2])
+    assert parsed[3].dtype == np.int64 and parsed[3].shape == (len(boxes), 4)
+    assert parsed[3].tolist() == [list(b) for b in boxes]
+    assert parsed[4] == labels
+    assert parsed[5].tolist() == ranks
+
+
+@pytest.mark.parametrize('labels', [
+    LABELS,
+    ['a & b', '<leaf>', 'say "hi"'],
+    ["it's", 'fleur de l’été', '&amp;'],
+])
+def test_matches_minidom_and_reads_back(labels):
+    boxes = BOXES[:len(labels)]
+    args = ('img_1.jpg', '/data/lib & co', '/home/<user>', 'PlantCLEF "2015"', DIMS)
+    text = voc_xml_string(*args, corner_points(boxes), labels, 2)
+    assert text == minidom_voc_xml(*args, boxes, labels, 2)
+
+    parsed = parse_own_voc_xml(text.encode('utf-8'))
+    assert parsed is not None
+    assert_parsed(parsed, '/home/<user>', 'PlantCLEF "2015"', DIMS, boxes, labels, [2] * len(boxes))
+    assert_parsed(parse_any_voc_xml(text.encode('utf-8')), *parsed[:2], DIMS, boxes, labels, [2] * len(boxes))
+
+
+def test_annotation_store_matches_corner_points():
+    store = AnnotationStore.from_boxes(np.asarray(BOXES), LABELS)
+    args = ('img.jpg', 'lib', 'cwd', 'Unknown', DIMS)
+    assert voc_xml_string(*args, store, None, -1) == voc_xml_string(*args, corner_points(BOXES), LABELS, -1)
+
+
+def test_empty_object_list():
+    args = ('img.jpg', 'lib', 'cwd', 'Unknown', DIMS)
+    text = voc_xml_string(*args, [], [], -1)
+    assert text == minidom_voc_xml(*args, [], [], -1)
+    parsed = parse_own_voc_xml(text.encode('utf-8'))
+    assert parsed is not None
+    assert_parsed(parsed, 'cwd', 'Unknown', DIMS, [], [], [])
+    assert_parsed(parse_any_voc_xml(text.encode('utf-8')), 'cwd', 'Unknown', DIMS, [], [], [])
+
+
+def test_empty_text_elements():
+    args = ('img.jpg', '', '', '', DIMS)
+    text = voc_xml_string(*args, corner_points(BOXES[:1]), [''], -1)
+    assert text == minidom_voc_xml(*args, BOXES[:1], [''], -1)
+    parsed = parse_own_voc_xml(text.encode('utf-8'))
+    assert parsed is not None
+    assert_parsed(parsed, None, None, DIMS, BOXES[:1], [None], [-1])
+    assert_parsed(parse_any_voc_xml(text.encode('utf-8')), None, None, DIMS, BOXES[:1], [None], [-1])
+
+
+# Files in any other layout are left to parse_any_voc_xml, and must read the same as through ElementTree
+@pytest.mark.parametrize('contents', [
+    # Windows newlines
+    minidom_voc_xml('img.jpg', 'lib', 'cwd', 'db', DIMS, BOXES, LABELS, 1).replace('\n', '\r\n'),
+    # Character references
+    minidom_voc_xml('img.jpg', 'lib', 'cwd', 'db', DIMS, BOXES, LABELS, 1).replace('flower', 'fl&#111;wer'),
+    # Indented with spaces, as written by other tools
+    minidom_voc_xml('img.jpg', 'lib', 'cwd', 'db', DIMS, BOXES, LABELS, 1).replace('\t', '    '),
+    # An extra element, and no trailing newline
+    minidom_voc_xml('img.jpg', 'lib', 'cwd', 'db', DIMS, BOXES, LABELS, 1).replace(
+        '<pose>', '<occluded>0</occluded>\n\t\t<pose>').rstrip('\n'),
+])
+def test_other_layouts_fall_back(contents):
+    data = contents.encode('utf-8')
+    assert parse_own_voc_xml(data) is None
+    root = et.fromstring(data)
+    labels = [obj.find('name').text for obj in root.iter('object')]
+    assert labels == LABELS
+    assert_parsed(parse_any_voc_xml(data), 'cwd', 'db', DIMS, BOXES, labels, [1] * len(BOXES))
+
+
+def test_missing_or_bad_observation_rank():
+    text = minidom_voc_xml('img.jpg', 'lib', 'cwd', 'db', DIMS, BOXES[:2], LABELS[:2], 3)
+    text = text.replace('\t\t<observation_rank>3</observation_rank>\n', '', 1)
+    text = text.replace('<observation_rank>3</observation_rank>', '<observation_rank>high</observation_rank>')
+    data = text.encode('utf-8')
+    assert parse_own_voc_xml(data) is None
+    assert parse_any_voc_xml(data)[5].tolist() == [NO_RANK, NO_RANK]
+
+
+def test_save_and_load_files(tmp_path):
+    lib = str(tmp_path)
+    os.makedirs(os.path.join(lib, 'sub.dir'))
+    filename = os.path.join('sub.dir', 'img.1.jpg')
+    labels = ['a & b'] + LABELS[1:]
+    save_to_voc_xml(filename, lib, 'cwd', 'db', DIMS, corner_points(BOXES), labels, '_annotations.xml', 0)
+    xml_file = os.path.join(lib, 'sub.dir', 'img_annotations.xml')
+    assert os.path.exists(xml_file)
+    assert_parsed(parse_voc_xml(xml_file), 'cwd', 'db', DIMS, BOXES, labels, [0] * len(BOXES))
+
+    xml_dims, boxes, loaded_labels = load_voc_boxes(lib, filename, '_annotations.xml')
+    assert xml_dims == (DIMS[1], DIMS[0], DIMS[2])
+    assert boxes.tolist() == [list(b) for b in BOXES]
+    assert loaded_labels == labels
+    assert load_from_voc_xml(lib, filename, '_annotations.xml') == ('cwd', 'db', xml_dims, corner_points(BOXES), labels)
+
+
+def test_missing_file(tmp_path):
+    xml_dims, boxes, labels = load_voc_boxes(str(tmp_path), 'img.jpg', '_annotations.xml')
+    assert xml_dims == () and boxes.shape == (0, 4) and labels == []
+    assert load_from_voc_xml(str(tmp_path), 'img.jpg', '_annotations.xml') == ('', '', (), [], [])
@@ -0,0 +1,163 @@
+"""
+Thumbnails of library images for the overview grid, cached on disk and made in the background, so that reviewing a
+library reads small files instead of decoding every image
+"""
+
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from image_cache import open_image
+
+THUMBNAIL_SIDE = 256
+THUMBNAIL_CACHE_DIR = os.path.join('configurations', 'thumbnails')
+# Layout of a page of the overview grid
+GRID_COLUMNS = 6
+GRID_ROWS = 4
+GRID_PAGE_SIZE = GRID_COLUMNS * GRID_ROWS
+GRID_PADDING = 8
+GRID_BACKGROUND = 40
+# Shown in place of thumbnails which haven't been made yet
+PLACEHOLDER_GRAY = 90
+
+
+# Decodes the image at path at no more than side pixels on its longer side and saves it as a JPEG at out_path, through
+# a temporary file so that a thumbnail is never read half-written
+def make_thumbnail(path, out_path, side=THUMBNAIL_SIDE):
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + '.tmp'
+    with open_image(path) as im:
+        # As in image_cache.decode_image, JPEGs are mostly scaled down by the decoder itself
+        im.thumbnail((side, side), reducing_gap=1.0)
+        im.convert('RGB').save(tmp_path, 'JPEG', quality=85)
+    os.replace(tmp_path, out_path)
+
+
+# Thumbnails of images kept as files in cache_dir, named by a hash of the image's absolute path and modification
+# time, so an image which changes on disk simply gets a new thumbnail. Missing thumbnails are made on a pool of worker
+# threads through request(); completed counts the thumbnails made so far, for pages waiting on them to poll.
+class ThumbnailCache:
+    def __init__(self, cache_dir=THUMBNAIL_CACHE_DIR, side=THUMBNAIL_SIDE, workers=4):
+        self.cache_dir = cache_dir
+        self.side = side
+        self.pending = {}
+        self.failed = set()
+        self.completed = 0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    # Where the thumbnail of the image at path is cached, or None if the image can't be found
+    def cache_path(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        key = hashlib.sha1('{}\n{}\n{}'.format(os.path.abspath(path), mtime, self.side).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.jpg')
+
+    # Returns the cached thumbnail of the image at path as an RGB array, or None if there is none yet
+    def load(self, path):
+        cache_path = self.cache_path(path)
+        if cache_path is None:
+            return None
+        try:
+            with Image.open(cache_path) as im:
+                return np.asarray(im.convert('RGB'))
+        except OSError:
+            return None
+
+    def cached(self, path):
+        cache_path = self.cache_path(path)
+        return cache_path is not None and os.path.exists(cache_path)
+
+    # Queues thumbnails to be made for those of paths (in order of priority) which have none. Queued work for paths
+    # no longer asked for is cancelled if it hasn't started yet, so paging through quickly doesn't build a backlog.
+    def request(self, paths):
+        wanted = set(paths)
+        with self.lock:
+            for path, future in list(self.pending.items()):
+                if path not in wanted and future.cancel():
+                    del self.pending[path]
+        for path in paths:
+            with self.lock:
+                if path in self.pending or path in self.failed:
+                    continue
+            cache_path = self.cache_path(path)
+            if cache_path is None or os.path.exists(cache_path):
+                continue
+            with self.lock:
+                self.pending[path] = self.pool.submit(self.worker, path, cache_path)
+
+    def worker(self, path, cache_path):
+        try:
+            make_thumbnail(path, cache_path, self.side)
+        except Exception as e:  # e.g. an unreadable image; shown as a placeholder rather than retried
+            print('WARNING: Could not make a thumbnail of {}: {}'.format(path, e))
+            with self.lock:
+                self.failed.add(path)
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+                self.completed += 1
+
+    def close(self):
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.pool.shutdown(wait=False)
+
+
+# One page of the overview grid: the thumbnails (arrays, or None where not made yet) of the images from index first
+# on, laid out row by row in one mosaic image. completed is the ThumbnailCache.completed count the page was made at.
+class ThumbnailPage:
+    def __init__(self, first, thumbnails, completed=0, columns=GRID_COLUMNS, rows=GRID_ROWS, side=THUMBNAIL_SIDE,
+                 padding=GRID_PADDING):
+        self.first = first
+        self.thumbnails = thumbnails
+        self.completed = completed
+        self.columns = columns
+        self.rows = rows
+        self.side = side
+        self.padding = padding
+        self.missing = [i for i, t in enumerate(thumbnails) if t is None]
+
+    def __len__(self):
+        return len(self.thumbnails)
+
+    # Top left corner of cell i in the mosaic
+    def cell_origin(self, i):
+        step = self.side + self.padding
+        return self.padding + i % self.columns * step, self.padding + i // self.columns * step
+
+    # Index (into the library) of the image whose cell contains mosaic position (x, y), or -1 if there is none
+    def image_at(self, x, y):
+        step = self.side + self.padding
+        col, col_x = divmod(x - self.padding, step)
+        row, row_y = divmod(y - self.padding, step)
+        i = int(row) * self.columns + int(col)
+        if not (0 <= col < self.columns and 0 <= row < self.rows and col_x < self.side and row_y < self.side) or \
+                i >= len(self.thumbnails):
+            return -1
+        return self.first + i
+
+    def compose(self):
+        step = self.side + self.padding
+        mosaic = np.full((self.rows * step + self.padding, self.columns * step + self.padding, 3), GRID_BACKGROUND,
+                         dtype=np.uint8)
+        for i, thumbnail in enumerate(self.thumbnails):
+            x, y = self.cell_origin(i)
+            if thumbnail is None:
+                mosaic[y:y + self.side, x:x + self.side] = PLACEHOLDER_GRAY
+            else:
+                mosaic[y:y + thumbnail.shape[0], x:x + thumbnail.shape[1]] = thumbnail[..., :3]
+        return mosaic
+
+    # Maps boxes (N x 4 array of x0, y0, x1, y1) of an image width pixels wide onto the thumbnail in cell i
+    def cell_boxes(self, i, boxes, width):
+        scale = self.thumbnails[i].shape[1] / width
+        x, y = self.cell_origin(i)
+        return np.asarray(boxes, dtype=np.float64).reshape(-1, 4) * scale + [x, y, x, y]
@@ -0,0 +1,154 @@
+"""
+Loading of every Pascal VOC annotation file in a dataset at once, into columnar NumPy arrays
+"""
+
+import os
+from functools import partial
+
+import numpy as np
+from voc_save_load import parse_voc_xml
+
+# Below this many files to (re-)read, starting worker processes costs more than it saves
+PROCESS_POOL_MIN_FILES = 500
+
+
+# Relative paths and modification times of all annotation files (ending in file_extension) under lib_path
+def scan_annotation_files(lib_path, file_extension):
+    files = []
+    mtimes = []
+    dirs = ['']
+    while dirs:
+        rel_dir = dirs.pop()
+        with os.scandir(os.path.join(lib_path, rel_dir)) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(os.path.join(rel_dir, entry.name))
+                elif entry.name.endswith(file_extension):
+                    files.append(os.path.join(rel_dir, entry.name))
+                    mtimes.append(entry.stat().st_mtime_ns)
+    order = sorted(range(len(files)), key=files.__getitem__)
+    return [files[i] for i in order], [mtimes[i] for i in order]
+
+
+# Reads the labels, boxes and observation ranks of one annotation file; unreadable files count as having no objects
+def read_boxes(lib_path, rel_path):
+    try:
+        _, _, _, boxes, labels, ranks = parse_voc_xml(os.path.join(lib_path, rel_path))
+    except (OSError, ValueError, KeyError, AttributeError, SyntaxError) as e:
+        print('WARNING: Could not read {}: {}'.format(rel_path, e))
+        return np.zeros((0, 4), dtype=np.int64), [], np.zeros(0, dtype=np.int64)
+    return boxes, labels, ranks
+
+
+# Every object of every annotation file in a dataset, stored column-wise: row i of each per-box array describes one
+# object, files[image_index[i]] is the annotation file it came from and classes[class_id[i]] is its label. The
+# objects of file j are rows file_offsets[j]:file_offsets[j + 1].
+class VOCDataset:
+    COLUMNS = ('image_index', 'class_id', 'xmin', 'ymin', 'xmax', 'ymax', 'observation_rank')
+
+    def __init__(self, files, mtimes, classes, file_offsets, image_index, class_id, xmin, ymin, xmax, ymax,
+                 observation_rank):
+        self.files = np.asarray(files, dtype=str)
+        self.mtimes = np.asarray(mtimes, dtype=np.int64)
+        self.classes = np.asarray(classes, dtype=str)
+        self.file_offsets = np.asarray(file_offsets, dtype=np.int64)
+        self.image_index = np.asarray(image_index, dtype=np.int32)
+        self.class_id = np.asarray(class_id, dtype=np.int32)
+        self.xmin = np.asarray(xmin, dtype=np.int32)
+        self.ymin = np.asarray(ymin, dtype=np.int32)
+        self.xmax = np.asarray(xmax, dtype=np.int32)
+        self.ymax = np.asarray(ymax, dtype=np.int32)
+        self.observation_rank = np.asarray(observation_rank, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.image_index)
+
+    # Builds a dataset from per-file results, each a (boxes, labels, ranks) tuple as returned by read_boxes
+    @classmethod
+    def from_files(cls, files, mtimes, results):
+        classes = sorted(set(label for _, labels, _ in results for label in labels if label is not None))
+        class_ids = {c: i for i, c in enumerate(classes)}
+        counts = [len(labels) for _, labels, _ in results]
+        boxes = np.concatenate([b for b, _, _ in results]) if results else np.zeros((0, 4), dtype=np.int64)
+        boxes = boxes.reshape(-1, 4)
+        return cls(files, mtimes, classes, np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+                   np.repeat(np.arange(len(files)), counts),
+                   [class_ids.get(label, -1) for _, labels, _ in results for label in labels],
+                   boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3],
+                   np.concatenate([r for _, _, r in results]) if results else [])
+
+    # Per-file (boxes, labels, ranks) tuples, as they would have been read from the files
+    def file_results(self):
+        results = []
+        boxes = np.stack([self.xmin, self.ymin, self.xmax, self.ymax], axis=1)
+        for j in range(len(self.files)):
+            start, end = self.file_offsets[j], self.file_offsets[j + 1]
+            labels = [self.classes[c] if c >= 0 else None for c in self.class_id[start:end]]
+            results.append((boxes[start:end], labels, self.observation_rank[start:end]))
+        return results
+
+    def save(self, cache_file):
+        np.savez(cache_file, files=self.files, mtimes=self.mtimes, classes=self.classes,
+                 file_offsets=self.file_offsets, **{c: getattr(self, c) for c in self.COLUMNS})
+
+    @classmethod
+    def load(cls, cache_file):
+        with np.load(cache_file) as saved:
+            return cls(saved['files'], saved['mtimes'], saved['classes'], saved['file_offsets'],
+                       *[saved[c] for c in cls.COLUMNS])
+
+    # Number of objects of each class, as a dictionary of class name to count
+    def class_counts(self):
+        counts = np.bincount(self.class_id[self.class_id >= 0], minlength=len(self.classes))
+        return dict(zip(self.classes.tolist(), counts.tolist()))
+
+    # Annotation files which contain at least one object of the given class
+    def files_with_class(self, class_name):
+        ids = np.flatnonzero(self.classes == class_name)
+        if len(ids) == 0:
+            return self.files[:0]
+        return self.files[np.unique(self.image_index[self.class_id == ids[0]])]
+
+    def box_widths(self):
+        return self.xmax - self.xmin
+
+    def box_heights(self):
+        return self.ymax - self.ymin
+
+
+# Loads all annotation files ending in file_extension under lib_path. With a cache_file (.npz), results from the
+# previous call are reused for files whose mtime hasn't changed and only new or modified files are read, on a
+# process pool when there are many of them.
+def load_voc_dataset(lib_path, file_extension='_annotations.xml', cache_file=None, workers=None):
+    files, mtimes = scan_annotation_files(lib_path, file_extension)
+    previous = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            cached = VOCDataset.load(cache_file)
+            previous = dict(zip(cached.files.tolist(), zip(cached.mtimes.tolist(), cached.file_results())))
+        except (OSError, ValueError, KeyError):
+            previous = {}
+
+    results = [None] * len(files)
+    changed = []
+    for i, (f, mtime) in enumerate(zip(files, mtimes)):
+        if f in previous and previous[f][0] == mtime:
+            results[i] = previous[f][1]
+        else:
+            changed.append(i)
+
+    read = partial(read_boxes, lib_path)
+    changed_files = [files[i] for i in changed]
+    if len(changed) >= PROCESS_POOL_MIN_FILES:
+        from concurrent.futures import ProcessPoolExecutor  # Loads multiprocessing, so only when needed
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            read_results = list(pool.map(read, changed_files, chunksize=256))
+    else:
+        read_results = [read(f) for f in changed_files]
+    for i, result in zip(changed, read_results):
+        results[i] = result
+
+    dataset = VOCDataset.from_files(files, mtimes, results)
+    if cache_file is not None and (changed or len(previous) != len(files)):
+        dataset.save(cache_file)
+    return dataset
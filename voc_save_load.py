@@ -3,52 +3,195 @@ Methods for saving annotations to Pascal VOC format
 """
 
 import os
-import colored
-import xml.etree.ElementTree as et
-from xml.dom import minidom
+import re
+import numpy as np
+from annotation_store import AnnotationStore
+from path_table import path_stem
 
-import json
+# Entities undone when reading text back, in this order ('&amp;' last, so that e.g. '&amp;lt;' reads as '&lt;')
+XML_ENTITIES = (('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'), ('&apos;', "'"), ('&amp;', '&'))
 
-error_msg = colored.fg("red") + colored.attr("bold")
+
+# Matches an element on a line of its own, as written by voc_xml_string. The text of the element is captured, unless
+# the element is empty (in which case it reads back as None).
+def element_re(tag, depth, capture=True):
+    return '\t' * depth + '<' + tag + '(?:/>|>(' + ('' if capture else '?:') + '[^<]+)</' + tag + '>)\n'
+
+
+VOC_HEADER_RE = re.compile(
+    '<\\?xml version="1\\.0" \\?>\n<annotation>\n' + element_re('folder', 1, False) +
+    element_re('filename', 1, False) + element_re('path', 1) +
+    '\t<source>\n' + element_re('database', 2) + '\t</source>\n\t<size>\n' +
+    ''.join('\t\t<{0}>([0-9]+)</{0}>\n'.format(tag) for tag in ('width', 'height', 'depth')) + '\t</size>\n')
+VOC_OBJECT_RE = re.compile(
+    '\t<object>\n' + element_re('name', 2) +
+    '\t\t<pose>[^<]*</pose>\n\t\t<truncated>[^<]*</truncated>\n\t\t<difficult>[^<]*</difficult>\n' +
+    '\t\t<observation_rank>(-?[0-9]+)</observation_rank>\n\t\t<bndbox>\n' +
+    ''.join('\t\t\t<{0}>(-?[0-9]+)</{0}>\n'.format(tag) for tag in ('xmin', 'ymin', 'xmax', 'ymax')) +
+    '\t\t</bndbox>\n\t</object>\n')
+VOC_FOOTER = '</annotation>\n'
+# Observation rank reported for objects which don't have one
+NO_RANK = -1
 
 
 # Takes annotation and other data for current image and translates into a Pascal VOC-formatted .xml file.
 def save_to_voc_xml(filename, folder, path, database, dims, annotations, labels, file_extension, observation_rank):
-
-    xml = et.Element('annotation')
-    fold = et.SubElement(xml, 'folder')
-    fold.text = folder
-    et.SubElement(xml, 'filename').text = filename
-    et.SubElement(xml, 'path').text = path
-    src = et.SubElement(xml, 'source')
-    et.SubElement(src, 'database').text = database
-    sz = et.SubElement(xml, 'size')
-    et.SubElement(sz, 'width').text = str(dims[1])
-    et.SubElement(sz, 'height').text = str(dims[0])
-    et.SubElement(sz, 'depth').text = str(dims[2])
-
-    for i in range(0, int(len(annotations) / 2)):
-        obj = et.SubElement(xml, 'object')
-        et.SubElement(obj, 'name').text = labels[i]
-        et.SubElement(obj, 'pose').text = 'Unspecified'
-        et.SubElement(obj, 'truncated').text = '0'
-        et.SubElement(obj, 'difficult').text = '0'
-        et.SubElement(obj, 'observation_rank').text = str(observation_rank)
-        bndbox = et.SubElement(obj, 'bndbox')
-        et.SubElement(bndbox, 'xmin').text = str(annotations[i * 2][0])
-        et.SubElement(bndbox, 'ymin').text = str(annotations[i * 2][1])
-        et.SubElement(bndbox, 'xmax').text = str(annotations[i * 2 + 1][0])
-        et.SubElement(bndbox, 'ymax').text = str(annotations[i * 2 + 1][1])
-
-    rough_string = et.tostring(xml, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    pretty_string = reparsed.toprettyxml(indent="\t")
-
-    p = filename.find('.')
-    with open(os.path.join(folder, filename[:p] + file_extension), 'w') as x:
+    pretty_string = voc_xml_string(filename, folder, path, database, dims, annotations, labels, observation_rank)
+    with open(os.path.join(folder, path_stem(filename) + file_extension), 'w') as x:
         x.writelines(pretty_string)
 
 
+# Escapes text the same way xml.dom.minidom writes it, after normalising newlines as an XML parser would
+def escape_text(text):
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+# A single line element with text content, indented by depth tabs
+def text_element(tag, text, depth):
+    if text is None or text == '':
+        return '\t' * depth + '<' + tag + '/>\n'
+    return '\t' * depth + '<' + tag + '>' + escape_text(str(text)) + '</' + tag + '>\n'
+
+
+# Returns the contents of the Pascal VOC .xml file for the given image and annotations, without writing it anywhere.
+# annotations is either an AnnotationStore (labels then being taken from it) or a flat list of corner points, two
+# per box. The file is written out directly as text; the output is identical to building it with ElementTree and
+# pretty-printing it with minidom.
+def voc_xml_string(filename, folder, path, database, dims, annotations, labels, observation_rank):
+    if isinstance(annotations, AnnotationStore):
+        boxes = annotations.voc_boxes().tolist()
+        labels = annotations.labels()
+    else:
+        boxes = [(p0[0], p0[1], p1[0], p1[1]) for p0, p1 in zip(annotations[0::2], annotations[1::2])]
+    parts = ['<?xml version="1.0" ?>\n<annotation>\n',
+             text_element('folder', folder, 1),
+             text_element('filename', filename, 1),
+             text_element('path', path, 1),
+             '\t<source>\n', text_element('database', database, 2), '\t</source>\n',
+             '\t<size>\n',
+             text_element('width', str(dims[1]), 2),
+             text_element('height', str(dims[0]), 2),
+             text_element('depth', str(dims[2]), 2),
+             '\t</size>\n']
+    rank = text_element('observation_rank', str(observation_rank), 2)
+    for (xmin, ymin, xmax, ymax), label in zip(boxes, labels):
+        parts += ['\t<object>\n',
+                  text_element('name', label, 2),
+                  '\t\t<pose>Unspecified</pose>\n\t\t<truncated>0</truncated>\n\t\t<difficult>0</difficult>\n',
+                  rank,
+                  '\t\t<bndbox>\n',
+                  text_element('xmin', str(xmin), 3),
+                  text_element('ymin', str(ymin), 3),
+                  text_element('xmax', str(xmax), 3),
+                  text_element('ymax', str(ymax), 3),
+                  '\t\t</bndbox>\n\t</object>\n']
+    parts.append('</annotation>\n')
+    return ''.join(parts)
+
+
+# Reads a Pascal VOC .xml file, returning its path, database, (width, height, depth) and the label, bounding box and
+# observation rank of every object. Boxes are returned as an N x 4 array of (xmin, ymin, xmax, ymax), and ranks as
+# an array of N integers, with NO_RANK for objects without a (numeric) observation rank.
+def parse_voc_xml(xml_file):
+    with open(xml_file, 'rb') as f:
+        contents = f.read()
+    parsed = parse_own_voc_xml(contents)
+    if parsed is None:
+        parsed = parse_any_voc_xml(contents)
+    return parsed
+
+
+# Fast path for files in exactly the layout written by voc_xml_string, read with regular expressions instead of
+# building an element tree. Returns None for anything else, which is then left to parse_any_voc_xml.
+def parse_own_voc_xml(contents):
+    if b'\r' in contents or b'&#' in contents:
+        return None
+    try:
+        text = contents.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    header = VOC_HEADER_RE.match(text)
+    if header is None or not text.endswith(VOC_FOOTER):
+        return None
+    path, database, width, height, depth = header.groups()
+    labels = []
+    coords = []
+    ranks = []
+    pos = header.end()
+    end = len(text) - len(VOC_FOOTER)
+    while pos < end:
+        obj = VOC_OBJECT_RE.match(text, pos)
+        if obj is None:
+            return None
+        name, rank, xmin, ymin, xmax, ymax = obj.groups()
+        labels.append(unescape_text(name))
+        coords += [int(xmin), int(ymin), int(xmax), int(ymax)]
+        ranks.append(int(rank))
+        pos = obj.end()
+    if pos != end:
+        return None
+    return unescape_text(path), unescape_text(database), (int(width), int(height), int(depth)), \
+        np.asarray(coords, dtype=np.int64).reshape(-1, 4), labels, np.asarray(ranks, dtype=np.int64)
+
+
+def unescape_text(text):
+    if text is None or '&' not in text:
+        return text
+    for entity, char in XML_ENTITIES:
+        text = text.replace(entity, char)
+    return text
+
+
+# General reader for Pascal VOC files from any source. ElementTree is only imported here, for the files which need it.
+def parse_any_voc_xml(contents):
+    import xml.etree.ElementTree as et
+    path = ''
+    database = ''
+    xml_dims = ()
+    labels = []
+    coords = []
+    ranks = []
+    root = et.fromstring(contents)
+    if root.find('path') is not None:
+        path = root.find('path').text
+    src = root.find('source')
+    if src is not None and src.find('database') is not None:
+        database = src.find('database').text
+    if root.find('size') is not None:
+        size = root.find('size')
+        xml_dims = (int(size.find('width').text), int(size.find('height').text), int(size.find('depth').text))
+    for obj in root.iter('object'):
+        labels.append(obj.find('name').text)
+        bndbox = obj.find('bndbox')
+        coords += [int(bndbox.find('xmin').text), int(bndbox.find('ymin').text),
+                   int(bndbox.find('xmax').text), int(bndbox.find('ymax').text)]
+        rank = obj.find('observation_rank')
+        try:
+            ranks.append(int(rank.text))
+        except (AttributeError, TypeError, ValueError):
+            ranks.append(NO_RANK)
+    return path, database, xml_dims, np.asarray(coords, dtype=np.int64).reshape(-1, 4), labels, \
+        np.asarray(ranks, dtype=np.int64)
+
+
+# Loads the annotations of an image as (xml_dims, boxes, labels), where boxes is an N x 4 array of
+# (xmin, ymin, xmax, ymax), or empty values if the image has no annotation file
+def load_voc_boxes(file_pth, filename, file_extension):
+    filename = os.path.join(file_pth, path_stem(filename) + file_extension)
+    if not os.path.exists(filename):
+        return (), np.zeros((0, 4), dtype=np.int64), []
+    _, _, xml_dims, boxes, labels, _ = parse_voc_xml(filename)
+    return xml_dims, boxes, labels
+
+
+# Loads the annotations of an image as (xml_dims, AnnotationStore), with label names interned in label_table if
+# given. The store is empty if the image has no annotation file.
+def load_annotation_store(file_pth, filename, file_extension, label_table=None):
+    xml_dims, boxes, labels = load_voc_boxes(file_pth, filename, file_extension)
+    return xml_dims, AnnotationStore.from_boxes(boxes, labels, label_table)
+
+
 # Reads in an xml file, pulls all important information and returns it to program in usable data format
 # NOTE: For metadata, currently only reads in path, image dimensions, and database,
 # and for each annotation, only reads label name and bounding box dimensions.
@@ -60,27 +203,12 @@ def load_from_voc_xml(file_pth, filename, file_extension):
     annotation = []
     labels = []
     xml_dims = ()
-    filename = os.path.join(file_pth, str(filename[:filename.find('.')]) + file_extension)
+    filename = os.path.join(file_pth, path_stem(filename) + file_extension)
 
     if os.path.exists(filename):
-        tree = et.parse(filename)
-        root = tree.getroot()
-        if root.find('path') is not None:
-            path = root.find('path').text
-        src = root.find('source')
-        if src is not None and src.find('database') is not None:
-            database = src.find('database').text
-        if root.find('size') is not None:
-            size = root.find('size')
-            width = int(size.find('width').text)
-            height = int(size.find('height').text)
-            depth = int(size.find('depth').text)
-            xml_dims = (width, height, depth)
-        for object in root.iter('object'):
-            labels.append(object.find('name').text)
-            annotation.append(
-                (int(object.find('bndbox').find('xmin').text), int(object.find('bndbox').find('ymin').text)))
-            annotation.append(
-                (int(object.find('bndbox').find('xmax').text), int(object.find('bndbox').find('ymax').text)))
+        path, database, xml_dims, boxes, labels, _ = parse_voc_xml(filename)
+        for xmin, ymin, xmax, ymax in boxes.tolist():
+            annotation.append((xmin, ymin))
+            annotation.append((xmax, ymax))
 
     return path, database, xml_dims, annotation, labels